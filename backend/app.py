@@ -1,8 +1,10 @@
-from flask import Flask, request, jsonify, session, send_from_directory
+from flask import Flask, request, jsonify, session, send_file, redirect
 from flask_cors import CORS
 import jwt
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, OperationFailure
 from bson import ObjectId
+from bson.errors import InvalidId
 import bcrypt
 from dotenv import load_dotenv
 import os
@@ -14,16 +16,27 @@ from email.mime.base import MIMEBase
 from email import encoders
 from datetime import datetime, timedelta, timezone
 import uuid
+import mimetypes
+import time
+import threading
+import re
+import html
 from werkzeug.utils import secure_filename
-from PIL import Image
-import io
+from werkzeug.security import safe_join
 from itsdangerous import URLSafeTimedSerializer
 from flask_mail import Mail, Message
 from routes.db import doctor_profiles_collection, doctor_availability_collection
 from routes.doctor_schedule_settings import schedule_settings
 from routes.doctor_schedule import doctor_schedule
-from routes.google_calendar import google_calendar
+from routes.google_calendar import google_calendar, ensure_calendar_indexes
 from routes.doctor_public_route import doctor_routes
+import merge_conversations
+import message_archive
+import image_processing
+import storage
+import upload_gc
+import video_session_reaper
+from webrtc_signaling import init_webrtc_signaling, video_session_room, video_session_state
 
 
 load_dotenv()
@@ -45,6 +58,16 @@ app.secret_key = secret_key
 
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_IMAGE_PIXELS'] = image_processing.MAX_IMAGE_PIXELS
+app.config['MAX_IMAGE_DIMENSION'] = image_processing.MAX_IMAGE_DIMENSION
+# An upload still 'processing' after this long was lost (worker restart, killed pool process)
+app.config['UPLOAD_PROCESSING_TIMEOUT'] = int(os.getenv('UPLOAD_PROCESSING_TIMEOUT_SECONDS', 600))
+# 'x-accel' (nginx X-Accel-Redirect) or 'x-sendfile' hands file bytes to the fronting proxy
+app.config['FILES_OFFLOAD'] = os.getenv('FILES_OFFLOAD', '').lower()
+app.config['FILES_ACCEL_PREFIX'] = os.getenv('FILES_ACCEL_PREFIX', '/protected-uploads')
+app.config['USE_X_SENDFILE'] = app.config['FILES_OFFLOAD'] == 'x-sendfile'
+app.config['VARIANT_CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.variants')
+app.config['VARIANT_CACHE_MAX_BYTES'] = int(os.getenv('VARIANT_CACHE_MAX_MB', 512)) * 1024 * 1024
 
 serializer = URLSafeTimedSerializer(app.config["SECRET_KEY"])
 
@@ -61,6 +84,16 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
 mail = Mail(app)
 
+file_store = storage.get_storage(app.config['UPLOAD_FOLDER'])
+
+variant_cache = image_processing.VariantCache(
+    app.config['VARIANT_CACHE_FOLDER'],
+    app.config['VARIANT_CACHE_MAX_BYTES']
+)
+
+# Uploaded file ids are immutable, so let browsers and CDNs keep them for a year
+FILES_MAX_AGE = 365 * 24 * 3600
+
 # Allowed image extensions only
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
@@ -68,82 +101,6 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def compress_image(image_file, max_size_mb=2, quality=85, max_dimension=1920):
-    """
-    Compress image file to reduce size while maintaining reasonable quality
-    
-    Args:
-        image_file: File object from request.files
-        max_size_mb: Maximum file size in MB (default: 2MB)
-        quality: JPEG quality (1-95, default: 85)
-        max_dimension: Maximum width or height (default: 1920px)
-    
-    Returns:
-        Compressed image as BytesIO object, file extension
-    """
-    try:
-        # Open the image
-        image = Image.open(image_file)
-        
-        # Convert RGBA to RGB if necessary (for JPEG compatibility)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            # Create a white background
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-            image = background
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Resize if image is too large
-        if max(image.size) > max_dimension:
-            # Calculate new size maintaining aspect ratio
-            ratio = max_dimension / max(image.size)
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-        
-        # Try different compression levels to achieve target size
-        for q in [quality, 75, 60, 45, 30]:
-            output = io.BytesIO()
-            
-            # Always save as JPEG for better compression
-            image.save(output, format='JPEG', quality=q, optimize=True)
-            output.seek(0)
-            
-            # Check if size is acceptable
-            size_mb = len(output.getvalue()) / (1024 * 1024)
-            
-            if size_mb <= max_size_mb:
-                output.seek(0)
-                return output, 'jpg'
-            
-            output.close()
-        
-        # If still too large, resize further
-        if max(image.size) > 1280:
-            ratio = 1280 / max(image.size)
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-            
-            output = io.BytesIO()
-            image.save(output, format='JPEG', quality=60, optimize=True)
-            output.seek(0)
-            return output, 'jpg'
-        
-        # Last resort - very aggressive compression
-        output = io.BytesIO()
-        image.save(output, format='JPEG', quality=30, optimize=True)
-        output.seek(0)
-        return output, 'jpg'
-        
-    except Exception as e:
-        print(f"Error compressing image: {e}")
-        # Return original file if compression fails
-        image_file.seek(0)
-        original_extension = image_file.filename.rsplit('.', 1)[1].lower()
-        return image_file, original_extension
-
 MONGO_URI = os.getenv('MONGO_URI')
 try:
     client = MongoClient(MONGO_URI)
@@ -160,8 +117,67 @@ conversations_collection = db.conversations
 doctor_profiles_collection = db.doctor_profiles
 patient_profiles_collection = db.patient_profiles
 video_sessions_collection = db.video_sessions
+uploads_collection = db.uploads
 doctor_availability_collection = db.doctor_availability
 
+def ensure_conversation_pair_index():
+    """One conversation per doctor/patient pair; start_conversation upserts on this key"""
+    try:
+        merge_conversations.ensure_pair_index(db)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        # Merging rewrites messages and adds unread counts up, so it is not done by
+        # every worker at import; until it runs, duplicates can still be created
+        print("❌ Duplicate conversations block the doctor_patient_pair index; "
+              "run `python merge_conversations.py` to merge them")
+
+def ensure_indexes():
+    """
+    Create the indexes the hot request paths rely on (idempotent)
+
+    Each index is created on its own, so one that fails doesn't prevent the others.
+    """
+    steps = [
+        ("doctor_patient_pair", ensure_conversation_pair_index),
+        # A patient's conversation list and search scope; patient_email is only the
+        # second key of doctor_patient_pair
+        ("conversation_patient", lambda: conversations_collection.create_index(
+            "patient_email",
+            name="conversation_patient"
+        )),
+        # History reads page by conversation, newest first
+        ("conversation_timeline", lambda: messages_collection.create_index(
+            [("conversation_id", 1), ("timestamp", -1), ("_id", -1)],
+            name="conversation_timeline"
+        )),
+        ("message archive", lambda: message_archive.ensure_archive_indexes(db)),
+        ("upload GC", lambda: upload_gc.ensure_gc_indexes(db)),
+        ("video sessions", lambda: video_session_reaper.ensure_video_session_indexes(db)),
+        ("calendar sync", lambda: ensure_calendar_indexes(db)),
+        # Full-text search over chat history, scoped by conversation
+        ("message_text", lambda: messages_collection.create_index(
+            [("message", "text")],
+            default_language="english",
+            name="message_text"
+        ))
+    ]
+    for name, create in steps:
+        try:
+            create()
+        except ConnectionFailure as e:
+            print("❌ Index creation failed, database unreachable:", e)
+            return
+        except Exception as e:
+            print(f"❌ Index creation failed ({name}):", e)
+
+ensure_indexes()
+
+# Optional in-process sweep for orphaned uploads (or run upload_gc.py from cron instead)
+if upload_gc.UPLOAD_GC_INTERVAL_MINUTES > 0:
+    upload_gc.start_gc_thread(db, file_store, variant_cache,
+                              incoming_folder=os.path.join(app.config['UPLOAD_FOLDER'], '.incoming'))
+
 # Register custom blueprints
 app.register_blueprint(doctor_schedule)
 app.register_blueprint(google_calendar)
@@ -617,6 +633,7 @@ def get_doctors(current_user):
             "specialization": doc.get("specialization", ""),
             "experience": doc.get("experience", ""),
             "profilePhoto": f"http://localhost:5000/api/files/{doc['profilePhoto']}" if doc.get("profilePhoto") else None,
+            "profilePhotoThumbnail": f"http://localhost:5000/api/files/{doc['profilePhoto']}?w=256" if doc.get("profilePhoto") else None,
             "email": doc.get("email",""),
             "qualification": doc.get("qualification","")
         })
@@ -656,9 +673,41 @@ def get_conversations(current_user):
     
     return jsonify({"conversations": result})
 
+def format_message(msg, sender_names):
+    """Shape a stored message for the client; sender_names caches name lookups per request"""
+    sender_email = msg.get('sender_email')
+    if sender_email not in sender_names:
+        sender = users_collection.find_one({"email": sender_email}, {"firstName": 1, "lastName": 1})
+        sender_names[sender_email] = f"{sender.get('firstName', '')} {sender.get('lastName', '')}".strip() if sender else "Unknown"
+    
+    message_item = {
+        "id": str(msg.get('_id')),
+        "sender_email": sender_email,
+        "sender_name": sender_names[sender_email],
+        "sender_role": msg.get('sender_role'),
+        "message": msg.get('message', ''),
+        "timestamp": msg.get('timestamp'),
+        "read": msg.get('read', False),
+        "message_type": msg.get('message_type', 'text')
+    }
+    
+    # Add image attachment info if present
+    if msg.get('image_attachment'):
+        message_item["image_attachment"] = msg.get('image_attachment')
+    
+    return message_item
+
 @app.route('/api/conversations/<conversation_id>/messages', methods=['GET'])
 @token_required
 def get_messages(current_user, conversation_id):
+    """
+    Get conversation history
+
+    Without a `limit` query parameter the whole hot (recent) history is returned.
+    With `limit` (and optionally the `before` cursor from the previous page) messages
+    are returned newest-page-first and paging continues into the archived cold tier
+    once the hot history is exhausted.
+    """
     from bson import ObjectId
     
     try:
@@ -670,43 +719,60 @@ def get_messages(current_user, conversation_id):
         if user_email not in [conversation.get('doctor_email'), conversation.get('patient_email')]:
             return jsonify({"error": "Unauthorized"}), 403
         
-        messages = messages_collection.find({
-            "conversation_id": ObjectId(conversation_id)
-        }).sort("timestamp", 1)
+        conv_oid = ObjectId(conversation_id)
+        sender_names = {}
+        limit = request.args.get('limit', type=int)
         
-        result = []
-        for msg in messages:
-            sender = users_collection.find_one({"email": msg.get('sender_email')})
-            sender_name = f"{sender.get('firstName', '')} {sender.get('lastName', '')}".strip() if sender else "Unknown"
-            
-            # Return message text only (no encryption)
-            message_data = msg.get('message', '')
-            
-            message_item = {
-                "id": str(msg.get('_id')),
-                "sender_email": msg.get('sender_email'),
-                "sender_name": sender_name,
-                "sender_role": msg.get('sender_role'),
-                "message": message_data,
-                "timestamp": msg.get('timestamp'),
-                "read": msg.get('read', False),
-                "message_type": msg.get('message_type', 'text')
+        if limit is None:
+            messages = messages_collection.find({"conversation_id": conv_oid}).sort("timestamp", 1)
+            result = [format_message(msg, sender_names) for msg in messages]
+            response = {
+                "messages": result,
+                "has_archived": message_archive.has_archived_messages(db, conv_oid)
             }
+        else:
+            limit = min(max(limit, 1), 200)
+            before = request.args.get('before')
+            try:
+                before = message_archive.decode_cursor(before) if before else None
+            except (ValueError, OverflowError, OSError, InvalidId):
+                return jsonify({"error": "Invalid cursor"}), 400
+            
+            hot_query = {"conversation_id": conv_oid}
+            if before:
+                hot_query["$or"] = [
+                    {"timestamp": {"$lt": before[0]}},
+                    {"timestamp": before[0], "_id": {"$lt": before[1]}}
+                ]
+            page = list(messages_collection.find(hot_query).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1))
+            has_more = len(page) > limit
+            page = page[:limit]
             
-            # Add image attachment info if present
-            if msg.get('image_attachment'):
-                message_item["image_attachment"] = msg.get('image_attachment')
+            # Only touch the cold tier once the client has scrolled past the hot history
+            if len(page) < limit:
+                cold_before = (page[-1]['timestamp'], page[-1]['_id']) if page else before
+                archived, has_more = message_archive.load_archived_messages(
+                    db, conv_oid, before=cold_before, limit=limit - len(page)
+                )
+                page.extend(archived)
+            elif not has_more:
+                has_more = message_archive.has_archived_messages(db, conv_oid)
             
-            result.append(message_item)
+            page.reverse()
+            response = {
+                "messages": [format_message(msg, sender_names) for msg in page],
+                "has_more": has_more,
+                "next_before": message_archive.encode_cursor(page[0]) if page and has_more else None
+            }
         
         # Mark messages as read for current user
         user_role = current_user.get('role')
         conversations_collection.update_one(
-            {"_id": ObjectId(conversation_id)},
+            {"_id": conv_oid},
             {"$set": {f"unread_count_{user_role}": 0}}
         )
         
-        return jsonify({"messages": result})
+        return jsonify(response)
     
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -778,6 +844,94 @@ def send_message(current_user, conversation_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
+def highlight_terms(text, terms, tag="mark"):
+    """Return HTML-escaped text with every word starting with a search term wrapped in <tag>"""
+    escaped = html.escape(text or '')
+    if not terms:
+        return escaped
+    # Text search stems words, so match on term prefixes rather than exact words
+    pattern = re.compile(r"\b(" + "|".join(re.escape(html.escape(t)) for t in terms) + r")\w*", re.IGNORECASE)
+    return pattern.sub(lambda m: f"<{tag}>{m.group(0)}</{tag}>", escaped)
+
+@app.route('/api/conversations/search', methods=['GET'])
+@token_required
+def search_messages(current_user):
+    """Full-text search over the messages of the caller's conversations"""
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "Search query is required"}), 400
+    
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "page and limit must be integers"}), 400
+    
+    user_email = current_user.get('email')
+    user_role = current_user.get('role')
+    
+    # Scope to the caller's conversations (doctor_patient_pair serves the doctor_email branch,
+    # conversation_patient the patient_email one)
+    scope = {"$or": [{"doctor_email": user_email}, {"patient_email": user_email}]}
+    conversation_id = request.args.get('conversation_id')
+    if conversation_id:
+        try:
+            scope["_id"] = ObjectId(conversation_id)
+        except Exception:
+            return jsonify({"error": "Invalid conversation ID"}), 400
+    
+    try:
+        conversations = {
+            conv['_id']: conv
+            for conv in conversations_collection.find(scope, {"doctor_email": 1, "patient_email": 1})
+        }
+        if not conversations:
+            return jsonify({"results": [], "page": page, "limit": limit, "total": 0, "has_more": False})
+    
+        search_filter = {
+            "$text": {"$search": query},
+            "conversation_id": {"$in": list(conversations.keys())}
+        }
+        total = messages_collection.count_documents(search_filter)
+        hits = messages_collection.find(
+            search_filter,
+            {
+                "score": {"$meta": "textScore"},
+                "conversation_id": 1,
+                "sender_email": 1,
+                "sender_role": 1,
+                "message": 1,
+                "timestamp": 1
+            }
+        ).sort([("score", {"$meta": "textScore"}), ("timestamp", -1)]).skip((page - 1) * limit).limit(limit)
+    
+        terms = [t.strip('"-') for t in query.split() if t.strip('"-')]
+        results = []
+        for msg in hits:
+            conv = conversations[msg['conversation_id']]
+            results.append({
+                "id": str(msg['_id']),
+                "conversation_id": str(msg['conversation_id']),
+                "other_user_email": conv.get('patient_email') if user_role == 'doctor' else conv.get('doctor_email'),
+                "sender_email": msg.get('sender_email'),
+                "sender_role": msg.get('sender_role'),
+                "message": msg.get('message', ''),
+                "highlighted": highlight_terms(msg.get('message', ''), terms),
+                "timestamp": msg.get('timestamp'),
+                "score": msg.get('score')
+            })
+    
+        return jsonify({
+            "results": results,
+            "page": page,
+            "limit": limit,
+            "total": total,
+            "has_more": page * limit < total
+        })
+    except Exception as e:
+        print(f"Error searching messages: {e}")
+        return jsonify({"error": "Failed to search messages"}), 500
+
 @app.route('/api/conversations/start', methods=['POST'])
 @token_required
 def start_conversation(current_user):
@@ -799,41 +953,116 @@ def start_conversation(current_user):
     if {user_role, other_role} != {'doctor', 'patient'}:
         return jsonify({"error": "Conversations only allowed between doctors and patients"}), 400
     
-    # Check if conversation already exists
-    existing_conv = conversations_collection.find_one({
-        "$or": [
-            {"doctor_email": user_email, "patient_email": other_user_email},
-            {"doctor_email": other_user_email, "patient_email": user_email}
-        ]
-    })
-    
-    if existing_conv:
-        return jsonify({
-            "conversation_id": str(existing_conv.get('_id')),
-            "message": "Conversation already exists"
-        })
-    
-    # Create new conversation
+    # Canonical pair key: roles are fixed, so (doctor_email, patient_email) is unique
     doctor_email = user_email if user_role == 'doctor' else other_user_email
     patient_email = other_user_email if user_role == 'doctor' else user_email
     
+    new_id = ObjectId()
+    now = datetime.now(timezone.utc)
     conversation_doc = {
-        "doctor_email": doctor_email,
-        "patient_email": patient_email,
-        "created_at": datetime.now(timezone.utc),
+        "_id": new_id,
+        "created_at": now,
         "last_message": "",
-        "last_message_time": datetime.now(timezone.utc),
+        "last_message_time": now,
         "unread_count_doctor": 0,
         "unread_count_patient": 0
     }
     
-    result = conversations_collection.insert_one(conversation_doc)
+    # Single upsert: returns the existing conversation, or None if we just created it
+    try:
+        existing_conv = conversations_collection.find_one_and_update(
+            {"doctor_email": doctor_email, "patient_email": patient_email},
+            {"$setOnInsert": conversation_doc},
+            projection={"_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # A concurrent start won the insert race; the pair now exists
+        existing_conv = conversations_collection.find_one(
+            {"doctor_email": doctor_email, "patient_email": patient_email},
+            {"_id": 1}
+        )
+    
+    if existing_conv:
+        return jsonify({
+            "conversation_id": str(existing_conv.get('_id')),
+            "message": "Conversation already exists"
+        })
     
     return jsonify({
-        "conversation_id": str(result.inserted_id),
+        "conversation_id": str(new_id),
         "message": "Conversation created successfully"
     }), 201
 
+KEY_EXCHANGE_MAX_WAIT = 25  # seconds a completion request may long-poll for the peer key
+KEY_EXCHANGE_POLL_INTERVAL = 1  # re-check the database this often (peer may be on another worker)
+
+class KeyExchangeWaiters:
+    """Lets completion requests sleep until the peer's key is stored by this process"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}  # key -> [event, number of waiters]
+    
+    def wait(self, key, timeout):
+        with self._lock:
+            entry = self._events.setdefault(key, [threading.Event(), 0])
+            entry[1] += 1
+        try:
+            return entry[0].wait(timeout)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                # The last waiter to give up removes the event, so abandoned exchanges don't pile up
+                if entry[1] == 0 and self._events.get(key) is entry:
+                    del self._events[key]
+    
+    def notify(self, key):
+        with self._lock:
+            entry = self._events.pop(key, None)
+        if entry:
+            entry[0].set()
+
+key_exchange_waiters = KeyExchangeWaiters()
+
+def store_public_key(current_user, conversation_id, public_key):
+    """
+    Store the caller's DH public key under dh_keys.<role> in one round trip
+
+    Returns:
+        (conversation document with dh_keys, None) or (None, error response tuple)
+    """
+    try:
+        conversation_obj_id = ObjectId(conversation_id)
+    except Exception:
+        return None, (jsonify({"error": "Invalid conversation ID"}), 400)
+    
+    user_email = current_user.get('email')
+    user_role = current_user.get('role')
+    if user_role not in ('doctor', 'patient'):
+        return None, (jsonify({"error": "Access denied"}), 403)
+    
+    # Membership check is part of the filter, so no separate read is needed
+    conversation = conversations_collection.find_one_and_update(
+        {"_id": conversation_obj_id, f"{user_role}_email": user_email},
+        {"$set": {f"dh_keys.{user_role}": {
+            "public_key": public_key,
+            "email": user_email,
+            "updated_at": datetime.now(timezone.utc)
+        }}},
+        projection={"dh_keys": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not conversation:
+        # Slow path only on failure: tell a missing conversation apart from a foreign one
+        if conversations_collection.find_one({"_id": conversation_obj_id}, {"_id": 1}):
+            return None, (jsonify({"error": "Access denied"}), 403)
+        return None, (jsonify({"error": "Conversation not found"}), 404)
+    
+    key_exchange_waiters.notify((conversation_id, user_role))
+    return conversation, None
+
 @app.route('/api/conversations/<conversation_id>/key-exchange/initiate', methods=['POST'])
 @token_required
 def initiate_key_exchange(current_user, conversation_id):
@@ -845,30 +1074,9 @@ def initiate_key_exchange(current_user, conversation_id):
         if not public_key:
             return jsonify({"error": "Public key is required"}), 400
         
-        # Verify conversation exists and user is part of it
-        try:
-            conversation_obj_id = ObjectId(conversation_id)
-        except:
-            return jsonify({"error": "Invalid conversation ID"}), 400
-            
-        conversation = conversations_collection.find_one({"_id": conversation_obj_id})
-        if not conversation:
-            return jsonify({"error": "Conversation not found"}), 404
-        
-        user_email = current_user.get('email')
-        if user_email not in [conversation.get('doctor_email'), conversation.get('patient_email')]:
-            return jsonify({"error": "Access denied"}), 403
-        
-        # Store the public key for this user in the conversation
-        update_data = {
-            f"dh_public_key_{user_email.replace('.', '_').replace('@', '_at_')}": public_key,
-            f"dh_key_updated_{user_email.replace('.', '_').replace('@', '_at_')}": datetime.now(timezone.utc)
-        }
-        
-        conversations_collection.update_one(
-            {"_id": conversation_obj_id},
-            {"$set": update_data}
-        )
+        conversation, error = store_public_key(current_user, conversation_id, public_key)
+        if error:
+            return error
         
         return jsonify({
             "message": "Key exchange initiated successfully",
@@ -881,7 +1089,12 @@ def initiate_key_exchange(current_user, conversation_id):
 @app.route('/api/conversations/<conversation_id>/key-exchange/complete', methods=['POST'])
 @token_required
 def complete_key_exchange(current_user, conversation_id):
-    """Complete Diffie-Hellman key exchange by providing public key and getting other party's key"""
+    """
+    Complete Diffie-Hellman key exchange by providing public key and getting other party's key
+
+    Pass `?wait=<seconds>` (max 25) to long-poll until the other party's key arrives
+    instead of polling this endpoint from the client.
+    """
     try:
         data = request.get_json()
         public_key = data.get('public_key')
@@ -889,45 +1102,30 @@ def complete_key_exchange(current_user, conversation_id):
         if not public_key:
             return jsonify({"error": "Public key is required"}), 400
         
-        # Verify conversation exists and user is part of it
-        try:
-            conversation_obj_id = ObjectId(conversation_id)
-        except:
-            return jsonify({"error": "Invalid conversation ID"}), 400
-            
-        conversation = conversations_collection.find_one({"_id": conversation_obj_id})
-        if not conversation:
-            return jsonify({"error": "Conversation not found"}), 404
-        
-        user_email = current_user.get('email')
-        if user_email not in [conversation.get('doctor_email'), conversation.get('patient_email')]:
-            return jsonify({"error": "Access denied"}), 403
-        
-        # Determine other user's email
-        other_email = conversation.get('doctor_email') if user_email == conversation.get('patient_email') else conversation.get('patient_email')
-        
-        # Store this user's public key
-        user_key_field = f"dh_public_key_{user_email.replace('.', '_').replace('@', '_at_')}"
-        other_key_field = f"dh_public_key_{other_email.replace('.', '_').replace('@', '_at_')}"
-        
-        update_data = {
-            user_key_field: public_key,
-            f"dh_key_updated_{user_email.replace('.', '_').replace('@', '_at_')}": datetime.now(timezone.utc)
-        }
-        
-        conversations_collection.update_one(
-            {"_id": conversation_obj_id},
-            {"$set": update_data}
-        )
-        
-        # Fetch updated conversation to get other party's public key
-        updated_conversation = conversations_collection.find_one({"_id": conversation_obj_id})
-        other_public_key = updated_conversation.get(other_key_field)
+        conversation, error = store_public_key(current_user, conversation_id, public_key)
+        if error:
+            return error
+        
+        other_role = 'patient' if current_user.get('role') == 'doctor' else 'doctor'
+        other_key = conversation.get('dh_keys', {}).get(other_role)
+        
+        wait = min(max(request.args.get('wait', 0, type=float), 0), KEY_EXCHANGE_MAX_WAIT)
+        deadline = time.monotonic() + wait
+        while not other_key and time.monotonic() < deadline:
+            key_exchange_waiters.wait(
+                (conversation_id, other_role),
+                min(KEY_EXCHANGE_POLL_INTERVAL, deadline - time.monotonic())
+            )
+            conversation = conversations_collection.find_one(
+                {"_id": ObjectId(conversation_id)},
+                {f"dh_keys.{other_role}": 1}
+            )
+            other_key = conversation.get('dh_keys', {}).get(other_role)
         
         response_data = {
-            "message": "Key exchange completed successfully",
+            "message": "Key exchange completed successfully" if other_key else "Waiting for other party's key",
             "conversation_id": conversation_id,
-            "other_public_key": other_public_key
+            "other_public_key": other_key.get('public_key') if other_key else None
         }
         
         return jsonify(response_data), 200
@@ -936,10 +1134,94 @@ def complete_key_exchange(current_user, conversation_id):
         return jsonify({"error": "Failed to complete key exchange"}), 500
 
 
+def finish_upload(file_id, spool_path, output_path, future):
+    """Done-callback for the image worker: store the output and record the outcome"""
+    try:
+        result = future.result()
+        file_store.save_file(file_id, output_path)
+    except Exception as e:
+        # The worker removes the spool itself, unless it died first (BrokenProcessPool)
+        for path in (spool_path, output_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        print(f"Image processing failed for {file_id}: {e}")
+        uploads_collection.update_one(
+            {"_id": file_id},
+            {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc)}}
+        )
+        return
+    
+    original_size = result["original_size"]
+    compression_ratio = (1 - result["file_size"] / original_size) * 100 if original_size > 0 else 0
+    print(f"Compression complete: {file_id} {result['file_size'] / 1024 / 1024:.2f} MB, saved {compression_ratio:.1f}% in {result['elapsed_ms']} ms")
+    
+    uploads_collection.update_one(
+        {"_id": file_id},
+        {"$set": {
+            "status": "ready",
+            "file_size": result["file_size"],
+            "file_type": result["file_type"],
+            "compression_stats": {
+                "original_size": original_size,
+                "compressed_size": result["file_size"],
+                "compression_ratio": f"{compression_ratio:.1f}%"
+            },
+            "encode_stats": result["encode_stats"],
+            "finished_at": datetime.now(timezone.utc)
+        }}
+    )
+
+def upload_response(file_id, original_filename, upload):
+    """Response body for an upload, shaped by its processing status"""
+    if upload.get('status') == 'ready':
+        return jsonify({
+            "message": "Image uploaded and compressed successfully",
+            "file_id": file_id,
+            "original_name": original_filename,
+            "status": "ready",
+            "file_size": upload.get('file_size'),
+            "file_type": upload.get('file_type'),
+            "compression_stats": upload.get('compression_stats')
+        }), 201
+    return jsonify({
+        "message": "Image uploaded, compression in progress",
+        "file_id": file_id,
+        "original_name": original_filename,
+        "status": "processing",
+        "status_url": f"/api/upload/{file_id}/status"
+    }), 202
+
+def claim_upload_retry(file_id, now):
+    """
+    Take over processing of an upload that failed or was lost while 'processing'
+
+    Only one caller wins the claim, so concurrent re-uploads queue the image once.
+    """
+    stale = now - timedelta(seconds=app.config['UPLOAD_PROCESSING_TIMEOUT'])
+    result = uploads_collection.update_one(
+        {"_id": file_id, "$or": [
+            {"status": "failed"},
+            {"status": "processing", "processing_started_at": {"$lt": stale}},
+            # Queued before processing_started_at was recorded
+            {"status": "processing", "processing_started_at": {"$exists": False}, "created_at": {"$lt": stale}}
+        ]},
+        {"$set": {"status": "processing", "processing_started_at": now}, "$unset": {"error": ""}}
+    )
+    return result.modified_count == 1
+
 @app.route('/api/upload', methods=['POST'])
 @token_required
 def upload_image(current_user):
-    """Upload image for messaging"""
+    """
+    Upload image for messaging
+
+    The upload is hashed while it is spooled to disk and stored under its content
+    hash, so re-uploading an identical image reuses the stored copy. New content is
+    compressed by a background worker: poll /api/upload/<file_id>/status until it
+    reports "ready" before attaching the file to a message.
+    """
     try:
         if 'file' not in request.files:
             return jsonify({"error": "No image provided"}), 400
@@ -951,66 +1233,198 @@ def upload_image(current_user):
         if file and allowed_file(file.filename):
             # Get original file info
             original_filename = secure_filename(file.filename)
-            file_content = file.read()
-            original_size = len(file_content)
-            file.seek(0)  # Reset file pointer
-            
-            # Compress the image
-            print(f"Compressing image: {original_filename}, original size: {original_size / 1024 / 1024:.2f} MB")
-            compressed_file, compressed_extension = compress_image(file)
+            original_extension = original_filename.rsplit('.', 1)[1].lower()
             
-            # Generate unique filename with compressed extension
-            unique_filename = f"{uuid.uuid4().hex}_{original_filename.rsplit('.', 1)[0]}.{compressed_extension}"
+            # Spool the raw upload next to the upload folder in bounded chunks, hashing it as it streams
+            incoming_folder = os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')
+            try:
+                spool_path, original_size, digest = storage.spool_upload(
+                    file.stream, incoming_folder,
+                    suffix=f".{original_extension}",
+                    max_bytes=app.config['MAX_CONTENT_LENGTH']
+                )
+            except storage.UploadTooLarge as e:
+                return jsonify({"error": str(e)}), 413
             
-            # Ensure upload directory exists
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            # Reject non-images and decompression bombs from the header, before any decode
+            try:
+                image_processing.probe_image(
+                    spool_path,
+                    max_pixels=app.config['MAX_IMAGE_PIXELS'],
+                    max_dimension=app.config['MAX_IMAGE_DIMENSION']
+                )
+            except image_processing.ImageRejected as e:
+                os.remove(spool_path)
+                return jsonify({"error": str(e)}), 400
             
-            # Save compressed file
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+            # Compressed output is always JPEG, so the final name is known up front
+            file_id = storage.content_id(digest, 'jpg')
             
-            if hasattr(compressed_file, 'read'):
-                # It's a BytesIO object from compression
-                with open(filepath, 'wb') as f:
-                    f.write(compressed_file.read())
-                compressed_file.close()
-            else:
-                # It's the original file (compression failed)
-                compressed_file.save(filepath)
+            # Record the upload; the document only starts out as 'processing' if the content is new
+            now = datetime.now(timezone.utc)
+            try:
+                existing = uploads_collection.find_one_and_update(
+                    {"_id": file_id},
+                    {
+                        "$set": {"last_uploaded_at": now},
+                        "$setOnInsert": {
+                            "status": "processing",
+                            "processing_started_at": now,
+                            "sha256": digest,
+                            "original_name": original_filename,
+                            "original_size": original_size,
+                            "uploaded_by": current_user.get('email'),
+                            "created_at": now
+                        }
+                    },
+                    upsert=True,
+                    return_document=ReturnDocument.BEFORE
+                )
+            except DuplicateKeyError:
+                # Identical upload raced us to the insert; reuse theirs
+                existing = uploads_collection.find_one_and_update(
+                    {"_id": file_id},
+                    {"$set": {"last_uploaded_at": now}}
+                )
             
-            # Get compressed file info
-            compressed_size = os.path.getsize(filepath)
-            compression_ratio = (1 - compressed_size / original_size) * 100 if original_size > 0 else 0
+            if existing and not claim_upload_retry(file_id, now):
+                os.remove(spool_path)
+                print(f"Deduplicated upload: {original_filename} -> {file_id}")
+                return upload_response(file_id, original_filename, existing)
             
-            print(f"Compression complete: {compressed_size / 1024 / 1024:.2f} MB, saved {compression_ratio:.1f}%")
+            print(f"Queued image for compression: {original_filename}, original size: {original_size / 1024 / 1024:.2f} MB")
+            output_path = f"{spool_path}.out"
+            try:
+                image_processing.submit_upload(
+                    spool_path,
+                    output_path,
+                    lambda future: finish_upload(file_id, spool_path, output_path, future)
+                )
+            except Exception as e:
+                os.remove(spool_path)
+                uploads_collection.update_one(
+                    {"_id": file_id},
+                    {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc)}}
+                )
+                raise
             
-            return jsonify({
-                "message": "Image uploaded and compressed successfully",
-                "file_id": unique_filename,
-                "original_name": original_filename,
-                "file_size": compressed_size,
-                "file_type": compressed_extension,
-                "compression_stats": {
-                    "original_size": original_size,
-                    "compressed_size": compressed_size,
-                    "compression_ratio": f"{compression_ratio:.1f}%"
-                }
-            }), 201
+            return upload_response(file_id, original_filename, {"status": "processing"})
         else:
             return jsonify({"error": "Only image files (PNG, JPG, JPEG, GIF) are allowed"}), 400
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/upload/<file_id>/status', methods=['GET'])
+@token_required
+def get_upload_status(current_user, file_id):
+    """Report whether a queued upload has finished processing"""
+    upload = uploads_collection.find_one({"_id": file_id})
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    
+    response = {
+        "file_id": file_id,
+        "status": upload.get('status'),
+        "original_name": upload.get('original_name')
+    }
+    if upload.get('status') == 'ready':
+        response.update({
+            "file_size": upload.get('file_size'),
+            "file_type": upload.get('file_type'),
+            "compression_stats": upload.get('compression_stats')
+        })
+    elif upload.get('status') == 'failed':
+        response["error"] = upload.get('error')
+    
+    return jsonify(response), 200
+
+def send_upload(path, etag=None, mimetype=None):
+    """
+    Send a stored upload with immutable caching, conditional GET and Range support
+
+    File ids never change content, so responses may be cached for a year. With
+    FILES_OFFLOAD set to 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd) only the
+    headers are produced here and the fronting proxy streams the bytes.
+    """
+    offload = app.config['FILES_OFFLOAD']
+    if offload == 'x-accel':
+        relative = os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        response = app.response_class(mimetype=mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{app.config['FILES_ACCEL_PREFIX'].rstrip('/')}/{relative}"
+        if etag:
+            response.set_etag(etag)
+            response.make_conditional(request)  # 304 here; the proxy handles Range
+    else:
+        response = send_file(
+            os.path.abspath(path),
+            mimetype=mimetype,
+            etag=etag if etag else True,
+            conditional=True,
+            max_age=FILES_MAX_AGE
+        )
+    response.headers['Cache-Control'] = f"public, max-age={FILES_MAX_AGE}, immutable"
+    return response
+
 @app.route('/api/files/<filename>')
 def serve_image(filename):
-    """Serve uploaded images"""
+    """
+    Serve uploaded images
+
+    `?w=<width>` serves a copy resized to the next width bucket (generated on first
+    request, then served from the variant cache); `&format=webp` switches its encoding.
+    Originals held in object storage are redirected to a presigned URL.
+    """
+    if not safe_join(app.config['UPLOAD_FOLDER'], filename):
+        return jsonify({"error": "File not found"}), 404
+    
+    source_path = file_store.local_path(filename)
+    if source_path is None and file_store.is_local:
+        return jsonify({"error": "File not found"}), 404
+    
+    # Content ids are the SHA-256 of the upload, which makes a free strong ETag
+    etag = filename.rsplit('.', 1)[0] if storage.is_content_id(filename) else None
+    
     try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    except Exception as e:
+        width = request.args.get('w', type=int)
+        fmt = request.args.get('format', 'jpeg').lower()
+        if width and width > 0 and fmt in image_processing.VariantCache.FORMATS:
+            variant = variant_cache.get(source_path or (lambda: file_store.open(filename)), filename, width, fmt)
+            if variant:
+                variant_path, mimetype = variant
+                variant_etag = os.path.basename(variant_path).rsplit('.', 1)[0] + f".{fmt}" if etag else None
+                return send_upload(variant_path, etag=variant_etag, mimetype=mimetype)
+        
+        if source_path:
+            return send_upload(source_path, etag=etag)
+        
+        # Object storage: the bucket serves the bytes; cache the redirect for less than the URL lives
+        response = redirect(file_store.download_url(filename))
+        response.headers['Cache-Control'] = f"private, max-age={file_store.url_expiry // 2}"
+        return response
+    except FileNotFoundError:
+        # Removed (or evicted from the variant cache) between the check and the send
         return jsonify({"error": "File not found"}), 404
+    except Exception as e:
+        print(f"Error serving file {filename}: {e}")
+        return jsonify({"error": "Failed to serve file"}), 500
     
 
 # Video Session Management Routes
+
+def publish_video_session(doc):
+    """Push a video session's new state to clients subscribed over Socket.IO"""
+    if socketio is not None and doc:
+        socketio.emit('video-session-state', video_session_state(doc), room=video_session_room(doc['_id']))
+
+def publish_reaped_sessions(session_ids):
+    for doc in video_sessions_collection.find({"_id": {"$in": session_ids}}):
+        publish_video_session(doc)
+
+# End video sessions nobody has touched for VIDEO_SESSION_IDLE_MINUTES
+if video_session_reaper.VIDEO_REAPER_INTERVAL_MINUTES > 0:
+    video_session_reaper.start_reaper_thread(db, on_reaped=publish_reaped_sessions)
+
 @app.route('/api/video/session/create', methods=['POST'])
 @token_required
 def create_video_session(current_user):
@@ -1041,8 +1455,8 @@ def create_video_session(current_user):
             return jsonify({"error": "Access denied to this appointment"}), 403
         
         # Check if session already exists for this appointment
-        existing_session = video_sessions_collection.find_one({"appointment_id": appointment_id})
-        if existing_session and existing_session.get('status') == 'active':
+        existing_session = video_sessions_collection.find_one({"appointment_id": appointment_id, "status": "active"})
+        if existing_session:
             return jsonify({
                 "session_id": str(existing_session['_id']),
                 "room_id": existing_session['room_id'],
@@ -1059,6 +1473,7 @@ def create_video_session(current_user):
             "patient_email": appointment.get('patientEmail'),
             "status": "active",
             "created_at": datetime.now(timezone.utc),
+            "last_activity": datetime.now(timezone.utc),
             "created_by": user_email,
             "participants": [],
             "session_data": {
@@ -1113,13 +1528,15 @@ def join_video_session(current_user, session_id):
         }
         
         # Update participants list
-        video_sessions_collection.update_one(
+        updated = video_sessions_collection.find_one_and_update(
             {"_id": ObjectId(session_id)},
             {
                 "$addToSet": {"participants": participant},
                 "$set": {"last_activity": datetime.now(timezone.utc)}
-            }
+            },
+            return_document=ReturnDocument.AFTER
         )
+        publish_video_session(updated)
         
         return jsonify({
             "room_id": session['room_id'],
@@ -1148,7 +1565,7 @@ def end_video_session(current_user, session_id):
             return jsonify({"error": "Only doctors can end the session"}), 403
         
         # Update session status
-        video_sessions_collection.update_one(
+        updated = video_sessions_collection.find_one_and_update(
             {"_id": ObjectId(session_id)},
             {
                 "$set": {
@@ -1156,8 +1573,10 @@ def end_video_session(current_user, session_id):
                     "ended_at": datetime.now(timezone.utc),
                     "ended_by": user_email
                 }
-            }
+            },
+            return_document=ReturnDocument.AFTER
         )
+        publish_video_session(updated)
         
         return jsonify({"message": "Video session ended successfully"}), 200
         
@@ -1243,6 +1662,14 @@ def get_appointment_video_session(current_user, appointment_id):
 
 # Add these routes to your app.py file (after the existing video session routes)
 
+PEER_HEARTBEAT_INTERVAL = 15  # seconds between client heartbeats
+PEER_STALE_SECONDS = 3 * PEER_HEARTBEAT_INTERVAL  # peers silent for longer are dropped
+
+def peer_is_stale(peer, cutoff):
+    """True if the peer's last heartbeat is older than cutoff (peers stored before heartbeats never are)"""
+    last_seen = peer.get('last_seen')
+    return last_seen is not None and last_seen < cutoff
+
 @app.route('/api/video/session/<session_id>/peer', methods=['POST'])
 @token_required
 def store_peer_id(current_user, session_id):
@@ -1253,18 +1680,14 @@ def store_peer_id(current_user, session_id):
         user_role = data.get('user_role')
         user_name = data.get('user_name')
         
-        if not peer_id:
+        if not peer_id or not isinstance(peer_id, str):
             return jsonify({"error": "Peer ID is required"}), 400
-        
-        session = video_sessions_collection.find_one({"_id": ObjectId(session_id)})
-        if not session:
-            return jsonify({"error": "Video session not found"}), 404
+        # user_role and user_name are optional, but stored as given inside $literal
+        if not all(value is None or isinstance(value, str) for value in (user_role, user_name)):
+            return jsonify({"error": "user_role and user_name must be strings"}), 400
         
         user_email = current_user.get('email')
-        
-        # Check access (more permissive for demo)
-        if session.get('status') != 'active':
-            return jsonify({"error": "Session is not active"}), 400
+        now = datetime.now(timezone.utc)
         
         # Store peer info
         peer_info = {
@@ -1272,30 +1695,34 @@ def store_peer_id(current_user, session_id):
             "user_email": user_email,
             "user_role": user_role,
             "user_name": user_name,
-            "joined_at": datetime.now(timezone.utc)
+            "joined_at": now,
+            "last_seen": now
         }
         
-        # Initialize peers array if it doesn't exist
-        video_sessions_collection.update_one(
-            {"_id": ObjectId(session_id)},
-            {"$setOnInsert": {"peers": []}}
-        )
-        
-        # Add or update peer in session
-        video_sessions_collection.update_one(
-            {"_id": ObjectId(session_id)},
-            {
-                "$pull": {"peers": {"user_email": user_email}},  # Remove existing entry
-                "$set": {"last_activity": datetime.now(timezone.utc)}
-            }
-        )
-        
-        video_sessions_collection.update_one(
-            {"_id": ObjectId(session_id)},
-            {
-                "$push": {"peers": peer_info}  # Add new entry
-            }
+        # Replace this user's entry (if any) and append the new one in a single
+        # atomic pipeline update, only while the session is active
+        session = video_sessions_collection.find_one_and_update(
+            {"_id": ObjectId(session_id), "status": "active"},
+            [{
+                "$set": {
+                    "peers": {"$concatArrays": [
+                        {"$filter": {
+                            "input": {"$ifNull": ["$peers", []]},
+                            "cond": {"$ne": ["$$this.user_email", user_email]}
+                        }},
+                        # $literal: client strings like "$status" are not field paths
+                        [{"$literal": peer_info}]
+                    ]},
+                    "last_activity": now
+                }
+            }],
+            return_document=ReturnDocument.AFTER
         )
+        if not session:
+            if video_sessions_collection.count_documents({"_id": ObjectId(session_id)}, limit=1):
+                return jsonify({"error": "Session is not active"}), 400
+            return jsonify({"error": "Video session not found"}), 404
+        publish_video_session(session)
         
         return jsonify({"message": "Peer ID stored successfully"}), 200
         
@@ -1305,19 +1732,52 @@ def store_peer_id(current_user, session_id):
         traceback.print_exc()
         return jsonify({"error": f"Failed to store peer ID: {str(e)}"}), 500
 
+@app.route('/api/video/session/<session_id>/heartbeat', methods=['POST'])
+@token_required
+def video_peer_heartbeat(current_user, session_id):
+    """Mark the caller's peer as still present (send every PEER_HEARTBEAT_INTERVAL seconds)"""
+    try:
+        now = datetime.now(timezone.utc)
+        result = video_sessions_collection.update_one(
+            {"_id": ObjectId(session_id), "status": "active", "peers.user_email": current_user.get('email')},
+            {"$set": {"peers.$.last_seen": now, "last_activity": now}}
+        )
+        if result.matched_count == 0:
+            return jsonify({"error": "Peer is not registered in an active session"}), 404
+        
+        return jsonify({"interval": PEER_HEARTBEAT_INTERVAL, "stale_after": PEER_STALE_SECONDS}), 200
+        
+    except Exception as e:
+        print(f"Error recording heartbeat: {e}")
+        return jsonify({"error": "Failed to record heartbeat"}), 500
+
 @app.route('/api/video/session/<session_id>/peers', methods=['GET'])
 @token_required
 def get_session_peers(current_user, session_id):
     """Get all peers in a video session"""
     try:
-        session = video_sessions_collection.find_one({"_id": ObjectId(session_id)})
+        user_email = current_user.get('email')
+        now = datetime.now(timezone.utc)
+        
+        # Polling the peer list counts as a heartbeat for the caller's own peer
+        session = video_sessions_collection.find_one_and_update(
+            {"_id": ObjectId(session_id), "status": "active", "peers.user_email": user_email},
+            {"$set": {"peers.$.last_seen": now, "last_activity": now}},
+            return_document=ReturnDocument.AFTER
+        ) or video_sessions_collection.find_one({"_id": ObjectId(session_id)})
         if not session:
             return jsonify({"error": "Video session not found"}), 404
         
-        user_email = current_user.get('email')
-        
         # More permissive access check for demo
-        peers = session.get('peers', [])
+        # Peers that stopped sending heartbeats (crashed tab, lost network) are expired here
+        cutoff = now.replace(tzinfo=None) - timedelta(seconds=PEER_STALE_SECONDS)
+        peers = [peer for peer in session.get('peers', []) if not peer_is_stale(peer, cutoff)]
+        if len(peers) != len(session.get('peers', [])):
+            publish_video_session(video_sessions_collection.find_one_and_update(
+                {"_id": session['_id']},
+                {"$pull": {"peers": {"last_seen": {"$lt": cutoff}}}},
+                return_document=ReturnDocument.AFTER
+            ))
         
         return jsonify({
             "peers": peers,
@@ -1339,13 +1799,14 @@ def leave_video_session(current_user, session_id):
         user_email = current_user.get('email')
         
         # Remove peer from session
-        result = video_sessions_collection.update_one(
+        publish_video_session(video_sessions_collection.find_one_and_update(
             {"_id": ObjectId(session_id)},
             {
                 "$pull": {"peers": {"user_email": user_email}},
                 "$set": {"last_activity": datetime.now(timezone.utc)}
-            }
-        )
+            },
+            return_document=ReturnDocument.AFTER
+        ))
         
         return jsonify({"message": "Left session successfully"}), 200
         
@@ -1462,6 +1923,18 @@ def update_appointment_status(current_user, appointment_id):
         return jsonify({"error": "Internal server error"}), 500
     
 
+# Socket.IO signaling server attached to the app by create_app()
+socketio = None
+
+def create_app():
+    """Return the Flask app with WebRTC signaling attached (safe to call more than once)"""
+    global socketio
+    if socketio is None:
+        socketio = init_webrtc_signaling(app)
+    return app
+
+
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    create_app()
+    socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
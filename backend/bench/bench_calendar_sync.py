@@ -0,0 +1,241 @@
+"""
+Benchmark for the Google Calendar busy-time sync.
+
+Serves a synthetic calendar (default 5,000 events) from an in-process stand-in for
+the Calendar API and times sync_busy_slots() against the previous approach, which
+ran one find_one per event before insert_many, re-listed full event bodies every time
+and read only the first page (250 events) of the listing. Each approach does a first
+sync into an empty collection, a re-sync after 10% of the events moved and 2% were
+cancelled, a re-sync of the unchanged calendar, and one after Google invalidated the
+sync token. Database round trips are counted with a
+pymongo command listener; API calls and response sizes by the stand-in.
+
+Usage:
+    MONGO_URI=mongodb://localhost:27017 python bench/bench_calendar_sync.py --events 5000
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+import httplib2
+from bson import ObjectId
+from dotenv import load_dotenv
+from googleapiclient.errors import HttpError
+from pymongo import MongoClient, monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from routes.google_calendar import ensure_calendar_indexes, sync_busy_slots  # noqa: E402
+
+DOCTOR_ID = "64b000000000000000000001"
+
+
+class FakeCalendar:
+    """
+    Stand-in for the calendar service from googleapiclient: service.events().list(...).execute()
+
+    Every change bumps a sequence number; a sync token is the sequence it was issued at,
+    so a syncToken list returns the events changed since then.
+    """
+
+    def __init__(self, events):
+        self.seq = 0
+        self.items = {}
+        for event in events:
+            self.put(event)
+        self.requests = 0
+        self.bytes = 0
+        self.oldest_valid_token = 0
+
+    def put(self, event):
+        self.seq += 1
+        self.items[event['id']] = dict(event, seq=self.seq)
+
+    def expire_tokens(self):
+        self.oldest_valid_token = self.seq + 1
+
+    def events(self):
+        return self
+
+    def list(self, **params):
+        self.requests += 1
+        return FakeRequest(self, params)
+
+
+class FakeRequest:
+    def __init__(self, calendar, params):
+        self.calendar = calendar
+        self.params = params
+
+    def execute(self):
+        calendar = self.calendar
+        if 'syncToken' in self.params:
+            since = int(self.params['syncToken'])
+            if since < calendar.oldest_valid_token:
+                raise HttpError(httplib2.Response({'status': 410}), b'{"error": {"code": 410}}')
+            events = [event for event in calendar.items.values() if event['seq'] > since]
+        else:
+            show_deleted = self.params.get('showDeleted', False)
+            time_min = self.params.get('timeMin', '')
+            time_max = self.params.get('timeMax')
+            events = [event for event in calendar.items.values()
+                      if (show_deleted or event['status'] != 'cancelled')
+                      and event['end']['dateTime'] > time_min
+                      and (not time_max or event['start']['dateTime'] < time_max)]
+
+        # Google pages at 250 events unless maxResults says otherwise
+        offset = int(self.params.get('pageToken', 0))
+        page_size = self.params.get('maxResults', 250)
+        more = offset + page_size < len(events)
+        events = events[offset:offset + page_size]
+
+        fields = self.params.get('fields')
+        items = []
+        for event in events:
+            if event['status'] == 'cancelled':
+                # Google keeps only the id and status of a deleted event
+                items.append({'id': event['id'], 'status': 'cancelled'})
+            elif fields:
+                items.append({key: event[key] for key in ('id', 'status', 'summary', 'start', 'end')})
+            else:
+                items.append({key: value for key, value in event.items() if key != 'seq'})
+
+        if more:
+            result = {'items': items, 'nextPageToken': str(offset + page_size)}
+        else:
+            result = {'items': items, 'nextSyncToken': str(calendar.seq)}
+        calendar.bytes += len(json.dumps(result))
+        return result
+
+
+def make_events(count, rng):
+    start = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    events = []
+    for i in range(count):
+        begins = start + datetime.timedelta(minutes=30 * i + rng.randrange(30))
+        events.append({
+            'id': f"evt{i:06d}",
+            'status': 'confirmed',
+            'summary': f"Busy {i}",
+            'start': {'dateTime': begins.isoformat()},
+            'end': {'dateTime': (begins + datetime.timedelta(minutes=25)).isoformat()},
+            # The rest of a typical event body, which the sync never reads
+            'kind': 'calendar#event',
+            'etag': f'"3{i:015d}"',
+            'htmlLink': f"https://www.google.com/calendar/event?eid=evt{i:06d}",
+            'description': "Follow-up consultation. " * rng.randint(1, 10),
+            'location': "Clinic room 3",
+            'creator': {'email': "doctor@bench.local", 'self': True},
+            'organizer': {'email': "doctor@bench.local", 'self': True},
+            'attendees': [{'email': f"patient{i}@bench.local", 'responseStatus': 'accepted'}],
+            'reminders': {'useDefault': True},
+            'iCalUID': f"evt{i:06d}@google.com",
+            'sequence': 0,
+        })
+    return events
+
+
+def change_events(calendar, rng, moved_ratio=0.1, cancelled_ratio=0.02):
+    events = list(calendar.items.values())
+    for event in rng.sample(events, int(len(events) * moved_ratio)):
+        begins = datetime.datetime.fromisoformat(event['start']['dateTime']) + datetime.timedelta(minutes=15)
+        calendar.put(dict(event, start={'dateTime': begins.isoformat()},
+                          end={'dateTime': (begins + datetime.timedelta(minutes=25)).isoformat()}))
+    for event in rng.sample(events, int(len(events) * cancelled_ratio)):
+        calendar.put(dict(calendar.items[event['id']], status='cancelled'))
+
+
+def legacy_sync(db, doctor_id, service):
+    """The per-event duplicate check sync_google_busy used to run"""
+    from dateutil.parser import isoparse
+
+    events = service.events().list(calendarId='primary', singleEvents=True, orderBy='startTime').execute()['items']
+    busy_slots = []
+    for event in events:
+        slot = {
+            "doctorId": doctor_id,
+            "startTime": isoparse(event['start']['dateTime']).astimezone().isoformat(),
+            "endTime": isoparse(event['end']['dateTime']).astimezone().isoformat(),
+            "reason": event.get("summary", "Google Calendar Event"),
+            "createdAt": datetime.datetime.now(datetime.timezone.utc),
+            "updatedAt": datetime.datetime.now(datetime.timezone.utc)
+        }
+        if not db.doctor_busy_time.find_one({
+            "doctorId": doctor_id, "startTime": slot["startTime"], "endTime": slot["endTime"]
+        }):
+            busy_slots.append(slot)
+    if busy_slots:
+        db.doctor_busy_time.insert_many(busy_slots)
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def token_sync(db, doctor_id, service):
+    """sync_busy_slots with the token the route would read from the user document"""
+    user = db.users.find_one({"_id": ObjectId(doctor_id)})
+    return sync_busy_slots(db, doctor_id, service, user.get("googleSyncToken"), user.get("googleSyncWindowEnd"))
+
+
+def run(label, db, counter, sync, events, seed):
+    rng = random.Random(seed)
+    calendar = FakeCalendar(events)
+    db.doctor_busy_time.drop()
+    db.users.delete_one({"_id": ObjectId(DOCTOR_ID)})
+    db.users.insert_one({"_id": ObjectId(DOCTOR_ID), "role": "doctor"})
+    ensure_calendar_indexes(db)
+
+    phases = [
+        ('first sync', None),
+        ('changed', lambda: change_events(calendar, rng)),
+        ('unchanged', None),
+        ('token 410', calendar.expire_tokens),
+    ]
+    for phase, prepare in phases:
+        if prepare:
+            prepare()
+        counter.count = 0
+        calendar.requests = calendar.bytes = 0
+        started = time.perf_counter()
+        sync(db, DOCTOR_ID, calendar)
+        elapsed = (time.perf_counter() - started) * 1000
+        rows = db.doctor_busy_time.count_documents({"doctorId": DOCTOR_ID})
+        print(f"{label:8} {phase:10} {elapsed:9.1f} ms  {counter.count:6} db round trips  "
+              f"{calendar.requests:2} API calls {calendar.bytes / 1024:9.1f} KB  {rows:6} rows")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--db", default="mediconnect_bench")
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    db = MongoClient(os.getenv("MONGO_URI"), event_listeners=[counter])[args.db]
+    events = make_events(args.events, random.Random(7))
+    live = args.events - int(args.events * 0.02)
+
+    print(f"{args.events} events; after the re-sync the calendar has {live} live events")
+    run("legacy", db, counter, legacy_sync, events, seed=1)
+    run("bulk", db, counter, token_sync, events, seed=1)
+    db.doctor_busy_time.drop()
+    db.users.delete_one({"_id": ObjectId(DOCTOR_ID)})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark for image_processing.compress_image against the previous quality-ladder encoder.
+
+The corpus is built from the screenshots and photos already in backend/uploads:
+each image as uploaded, a "phone camera" version (JPEG q95 upscaled to 4032px, the size a
+modern phone produces) and a "retina screenshot" version (PNG at 2x). An extra case with
+a 100KB budget exercises the over-budget search path.
+
+Usage:
+    python bench/bench_compress.py [--runs 3] [--keep-corpus DIR]
+"""
+import argparse
+import glob
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from image_processing import compress_image  # noqa: E402
+
+UPLOADS = os.path.join(os.path.dirname(__file__), '..', 'uploads')
+
+
+def legacy_compress_image(image_file, max_size_mb=2, quality=85, max_dimension=1920, stats=None):
+    """The encoder compress_image replaced: full decode, then a fixed quality ladder"""
+    stats['encodes'] = 0
+    image = Image.open(image_file)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > max_dimension:
+        ratio = max_dimension / max(image.size)
+        image = image.resize(tuple(int(dim * ratio) for dim in image.size), Image.Resampling.LANCZOS)
+    for q in [quality, 75, 60, 45, 30]:
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=q, optimize=True)
+        stats['encodes'] += 1
+        if len(output.getvalue()) / (1024 * 1024) <= max_size_mb:
+            return output, 'jpg'
+    final_quality = 30
+    if max(image.size) > 1280:
+        ratio = 1280 / max(image.size)
+        image = image.resize(tuple(int(dim * ratio) for dim in image.size), Image.Resampling.LANCZOS)
+        final_quality = 60
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=final_quality, optimize=True)
+    stats['encodes'] += 1
+    return output, 'jpg'
+
+
+def build_corpus(directory):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(UPLOADS, '*'))):
+        try:
+            with Image.open(path) as probe:
+                fmt = probe.format
+        except Exception:
+            continue  # the PDFs stored in uploads/
+        name = os.path.basename(path).split('_', 1)[1]
+        corpus.append((f"as-uploaded/{name}", path, 2))
+
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+            if fmt == 'JPEG':
+                ratio = 4032 / max(image.size)
+                big = image.resize(tuple(int(d * ratio) for d in image.size), Image.Resampling.BICUBIC)
+                out = os.path.join(directory, f"camera_{name}.jpg")
+                big.save(out, format='JPEG', quality=95)
+                corpus.append((f"camera-4032/{name}", out, 2))
+                corpus.append((f"camera-4032-100KB/{name}", out, 0.1))
+            else:
+                big = image.resize((image.width * 2, image.height * 2), Image.Resampling.BICUBIC)
+                out = os.path.join(directory, f"retina_{name}.png")
+                big.save(out, format='PNG')
+                corpus.append((f"retina-2x/{name}", out, 2))
+    return corpus
+
+
+def run(fn, path, max_size_mb, runs):
+    timings, stats = [], {}
+    for _ in range(runs):
+        stats = {}
+        with open(path, 'rb') as f:
+            started = time.perf_counter()
+            output, _ = fn(f, max_size_mb=max_size_mb, stats=stats)
+            timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), stats['encodes'], len(output.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--keep-corpus", help="Write the generated corpus here instead of a temp dir")
+    args = parser.parse_args()
+
+    directory = args.keep_corpus or tempfile.mkdtemp(prefix="mediconnect-corpus-")
+    os.makedirs(directory, exist_ok=True)
+    corpus = build_corpus(directory)
+
+    print(f"{'case':58} {'legacy ms':>9} {'enc':>3} {'bytes':>8}   {'new ms':>8} {'enc':>3} {'bytes':>8}")
+    totals = [0.0, 0, 0.0, 0]
+    for label, path, budget in corpus:
+        old_ms, old_enc, old_bytes = run(legacy_compress_image, path, budget, args.runs)
+        new_ms, new_enc, new_bytes = run(compress_image, path, budget, args.runs)
+        totals = [totals[0] + old_ms, totals[1] + old_enc, totals[2] + new_ms, totals[3] + new_enc]
+        print(f"{label[:58]:58} {old_ms:9.1f} {old_enc:3d} {old_bytes:8d}   {new_ms:8.1f} {new_enc:3d} {new_bytes:8d}")
+    print(f"{'total':58} {totals[0]:9.1f} {totals[1]:3d} {'':8}   {totals[2]:8.1f} {totals[3]:3d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark for /api/conversations/search backing query.
+
+Seeds a scratch database with synthetic chat history (default 1M messages spread
+over 5k conversations) and times the same $text query search_messages() runs,
+scoped to one user's conversations, against the unscoped regex scan a client
+would otherwise need.
+
+Usage:
+    MONGO_URI=mongodb://localhost:27017 python bench/bench_message_search.py --messages 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+WORDS = (
+    "appointment prescription dosage headache fever allergy blood pressure test results "
+    "follow up clinic tomorrow morning evening pain medication refill insurance report "
+    "scan xray symptoms cough rash sleep diet exercise thanks please schedule reschedule"
+).split()
+
+
+def seed(db, total_messages, conversations, batch_size=10000):
+    db.messages.drop()
+    db.conversations.drop()
+
+    conv_docs = []
+    for i in range(conversations):
+        conv_docs.append({
+            "_id": ObjectId(),
+            "doctor_email": f"doctor{i % 200}@bench.local",
+            "patient_email": f"patient{i}@bench.local",
+        })
+    db.conversations.insert_many(conv_docs)
+    db.conversations.create_index([("doctor_email", 1), ("patient_email", 1)], unique=True)
+
+    start = datetime.now(timezone.utc) - timedelta(days=365)
+    rng = random.Random(42)
+    inserted = 0
+    while inserted < total_messages:
+        batch = []
+        for _ in range(min(batch_size, total_messages - inserted)):
+            conv = conv_docs[rng.randrange(conversations)]
+            batch.append({
+                "conversation_id": conv["_id"],
+                "sender_email": conv["patient_email"],
+                "sender_role": "patient",
+                "message": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))),
+                "timestamp": start + timedelta(seconds=inserted),
+                "read": True,
+                "message_type": "text",
+            })
+            inserted += 1
+        db.messages.insert_many(batch, ordered=False)
+
+    t0 = time.perf_counter()
+    db.messages.create_index([("message", "text")], default_language="english", name="message_text")
+    print(f"Seeded {inserted} messages; text index built in {time.perf_counter() - t0:.1f}s")
+
+
+def time_query(fn, runs):
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": statistics.median(samples),
+        "p95_ms": samples[int(len(samples) * 0.95) - 1] if len(samples) > 1 else samples[0],
+        "max_ms": samples[-1],
+    }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--conversations", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--db", default="mediconnect_bench")
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv("MONGO_URI"))[args.db]
+    if not args.skip_seed:
+        seed(db, args.messages, args.conversations)
+
+    # A doctor with ~25 conversations, like a real practice inbox
+    email = "doctor7@bench.local"
+    conv_ids = [c["_id"] for c in db.conversations.find(
+        {"$or": [{"doctor_email": email}, {"patient_email": email}]}, {"_id": 1})]
+
+    def text_search():
+        list(db.messages.find(
+            {"$text": {"$search": "prescription refill"}, "conversation_id": {"$in": conv_ids}},
+            {"score": {"$meta": "textScore"}, "message": 1},
+        ).sort([("score", {"$meta": "textScore"})]).limit(20))
+
+    def regex_scan():
+        list(db.messages.find(
+            {"message": {"$regex": "prescription|refill", "$options": "i"}, "conversation_id": {"$in": conv_ids}},
+            {"message": 1},
+        ).limit(20))
+
+    print(f"Scoped to {len(conv_ids)} conversations")
+    print("text index :", time_query(text_search, args.runs))
+    print("regex scan :", time_query(regex_scan, max(args.runs // 10, 1)))
+
+
+if __name__ == "__main__":
+    main()
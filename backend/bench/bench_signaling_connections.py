@@ -0,0 +1,133 @@
+"""
+Connection-scaling benchmark for the standalone signaling server.
+
+For each async mode, starts signaling_server.py, connects N Socket.IO clients over
+websocket (two per room, like a consultation), and reports how long the connects took,
+the server's RSS and OS thread count with every socket open, and the ping/pong round
+trip of a sample of clients under that load. The clients run as greenlets, so the
+benchmark process itself stays small.
+
+Usage:
+    python bench/bench_signaling_connections.py [--clients 1000] [--modes threading gevent]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import resource  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+import requests  # noqa: E402
+import socketio  # noqa: E402
+from gevent.event import Event  # noqa: E402
+from gevent.pool import Pool  # noqa: E402
+
+BACKEND = os.path.join(os.path.dirname(__file__), '..')
+
+
+def proc_status(pid):
+    """(RSS in MB, OS threads) of pid from /proc (Linux only)"""
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            fields[key] = value.strip()
+    return int(fields['VmRSS'].split()[0]) / 1024, int(fields['Threads'])
+
+
+def start_server(mode, port, extra_env=None):
+    env = dict(os.environ, SIGNALING_ASYNC_MODE=mode, SIGNALING_PORT=str(port), SIGNALING_REDIS_URL='', **(extra_env or {}))
+    server = subprocess.Popen(
+        [sys.executable, 'signaling_server.py'],
+        cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"signaling server ({mode}) did not start")
+
+
+def connect_client(url, index):
+    client = socketio.Client(reconnection=False)
+    pong = Event()
+    client.on('pong', lambda data: pong.set())
+    client.connect(url, transports=['websocket'], wait_timeout=30)
+    client.emit('join-room', {
+        'roomId': f"bench-room-{index // 2}",
+        'userRole': 'doctor' if index % 2 == 0 else 'patient',
+        'userName': f"bench-{index}"
+    })
+    return client, pong
+
+
+def ping_rtt(client, pong):
+    pong.clear()
+    started = time.perf_counter()
+    client.emit('ping')
+    pong.wait(timeout=10)
+    return (time.perf_counter() - started) * 1000
+
+
+def run_mode(mode, clients, port, concurrency):
+    server = start_server(mode, port)
+    url = f"http://127.0.0.1:{port}"
+    connected = []
+    try:
+        idle_rss, idle_threads = proc_status(server.pid)
+        started = time.perf_counter()
+        pool = Pool(concurrency)
+        jobs = [pool.spawn(connect_client, url, i) for i in range(clients)]
+        gevent.joinall(jobs)
+        connect_s = time.perf_counter() - started
+        connected = [job.value for job in jobs if job.successful()]
+        time.sleep(1)  # let the server settle before sampling
+
+        rss, threads = proc_status(server.pid)
+        sample = connected[::max(1, len(connected) // 50)]
+        rtts = sorted(ping_rtt(client, pong) for client, pong in sample)
+        return {
+            'mode': mode,
+            'connected': len(connected),
+            'connect_s': connect_s,
+            'rss_mb': rss - idle_rss,
+            'threads': threads - idle_threads,
+            'rtt_p50': statistics.median(rtts) if rtts else float('nan'),
+            'rtt_p95': rtts[int(len(rtts) * 0.95)] if rtts else float('nan')
+        }
+    finally:
+        server.kill()
+        server.wait()
+        # With the server gone the clients only have to tear down their own transports
+        gevent.joinall([gevent.spawn(client.disconnect) for client, _ in connected], timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--modes", nargs='+', default=['threading', 'gevent'])
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--concurrency", type=int, default=100, help="Connects in flight at once")
+    args = parser.parse_args()
+
+    # Each client needs a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f"{'mode':10} {'connected':>9} {'connect s':>9} {'+RSS MB':>8} {'+threads':>8} {'rtt p50 ms':>10} {'rtt p95 ms':>10}")
+    for mode in args.modes:
+        r = run_mode(mode, args.clients, args.port, args.concurrency)
+        print(f"{r['mode']:10} {r['connected']:9d} {r['connect_s']:9.2f} {r['rss_mb']:8.1f} {r['threads']:8d} "
+              f"{r['rtt_p50']:10.2f} {r['rtt_p95']:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
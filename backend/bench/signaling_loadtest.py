@@ -0,0 +1,189 @@
+"""
+Load test for the WebRTC signaling server.
+
+Runs N consultation rooms concurrently. In each cycle a doctor and a patient client
+connect, join the room, exchange a targeted offer and answer, trickle ICE candidates
+(ending with an end-of-candidates marker) and leave. Reports connect and call-setup
+latency percentiles, relay throughput and the server's memory.
+
+By default a local signaling_server.py is started for the run; pass --url to test a
+server that is already running (memory is then not reported). All clients run as
+greenlets in this one process, which becomes the bottleneck first; for more load, run
+several copies against the same --url.
+
+Usage:
+    python bench/signaling_loadtest.py [--rooms 200] [--cycles 3] [--candidates 8]
+                                       [--mode gevent] [--ice-batch-ms 0] [--url URL]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+import socketio  # noqa: E402
+from gevent.event import Event  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(__file__))
+from bench_signaling_connections import proc_status, start_server  # noqa: E402
+
+
+class Peer:
+    """One signaling client that records when the events it waits for arrive"""
+
+    def __init__(self, url, name, role):
+        self.name = name
+        self.role = role
+        self.client = socketio.Client(reconnection=False)
+        self.sid = None
+        self.events = {name: Event() for name in ('joined-room', 'user-joined', 'offer', 'answer', 'ice-done')}
+        self.candidates = 0
+        self.expected_candidates = 0
+        self.received = 0
+
+        for event in ('joined-room', 'user-joined', 'offer', 'answer'):
+            self.client.on(event, self._setter(event))
+        self.client.on('ice-candidate', lambda data: self._got_candidates(1))
+        self.client.on('ice-candidates', lambda data: self._got_candidates(len(data['candidates'])))
+
+        started = time.perf_counter()
+        self.client.connect(url, transports=['websocket'], wait_timeout=30)
+        self.connect_ms = (time.perf_counter() - started) * 1000
+        self.sid = self.client.get_sid()
+
+    def _setter(self, event):
+        def handler(data):
+            self.received += 1
+            self.events[event].set()
+        return handler
+
+    def _got_candidates(self, count):
+        self.received += 1
+        self.candidates += count
+        if self.candidates >= self.expected_candidates:
+            self.events['ice-done'].set()
+
+    def wait(self, event, timeout=30):
+        if not self.events[event].wait(timeout):
+            raise TimeoutError(f"{self.name} timed out waiting for {event}")
+
+    def reset(self, expected_candidates):
+        for event in self.events.values():
+            event.clear()
+        self.candidates = 0
+        self.expected_candidates = expected_candidates
+
+    def trickle(self, room_id, to, count):
+        for i in range(count):
+            self.client.emit('ice-candidate', {
+                'roomId': room_id,
+                'to': to,
+                'candidate': {'candidate': f"candidate:{i} 1 udp 2122260223 10.0.0.{i} 5{i:04d} typ host", 'sdpMid': '0'}
+            })
+        self.client.emit('ice-candidate', {'roomId': room_id, 'to': to, 'candidate': None})
+
+
+def run_room(url, index, cycles, candidates, results):
+    room_id = f"loadtest-{index}"
+    for cycle in range(cycles):
+        doctor = Peer(url, f"doctor-{index}", 'doctor')
+        patient = Peer(url, f"patient-{index}", 'patient')
+        results['connect_ms'] += [doctor.connect_ms, patient.connect_ms]
+        # Each side also receives the end-of-candidates marker
+        doctor.reset(candidates + 1)
+        patient.reset(candidates + 1)
+
+        started = time.perf_counter()
+        doctor.client.emit('join-room', {'roomId': room_id, 'userRole': 'doctor', 'userName': doctor.name})
+        doctor.wait('joined-room')
+        patient.client.emit('join-room', {'roomId': room_id, 'userRole': 'patient', 'userName': patient.name})
+        doctor.wait('user-joined')
+
+        doctor.client.emit('offer', {'roomId': room_id, 'to': patient.sid, 'offer': {'type': 'offer', 'sdp': 'v=0' * 200}})
+        patient.wait('offer')
+        patient.client.emit('answer', {'roomId': room_id, 'to': doctor.sid, 'answer': {'type': 'answer', 'sdp': 'v=0' * 200}})
+        doctor.wait('answer')
+        results['negotiate_ms'].append((time.perf_counter() - started) * 1000)
+
+        gevent.joinall([
+            gevent.spawn(doctor.trickle, room_id, patient.sid, candidates),
+            gevent.spawn(patient.trickle, room_id, doctor.sid, candidates)
+        ])
+        doctor.wait('ice-done')
+        patient.wait('ice-done')
+        results['setup_ms'].append((time.perf_counter() - started) * 1000)
+
+        # Relayed messages the server delivered to these two clients
+        results['relayed'] += doctor.received + patient.received
+        for peer in (doctor, patient):
+            peer.client.emit('leave-room', {'roomId': room_id})
+            # The client's disconnect() waits out its read loop; don't count that time
+            results['disconnects'].append(gevent.spawn(peer.client.disconnect))
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]  # noqa: E731
+    return f"p50 {pick(0.5):8.1f}  p95 {pick(0.95):8.1f}  p99 {pick(0.99):8.1f}  max {values[-1]:8.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=200, help="Concurrent consultations")
+    parser.add_argument("--cycles", type=int, default=3, help="Join/negotiate/leave cycles per room")
+    parser.add_argument("--candidates", type=int, default=8, help="ICE candidates trickled by each side")
+    parser.add_argument("--mode", default='gevent', help="SIGNALING_ASYNC_MODE for the local server")
+    parser.add_argument("--ice-batch-ms", type=int, default=0, help="SIGNALING_ICE_BATCH_MS for the local server")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--url", help="Test an already running server instead of starting one")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        server = start_server(args.mode, args.port, {'SIGNALING_ICE_BATCH_MS': str(args.ice_batch_ms)})
+        url = f"http://127.0.0.1:{args.port}"
+
+    results = {'connect_ms': [], 'negotiate_ms': [], 'setup_ms': [], 'relayed': 0, 'disconnects': []}
+    peak_rss = [0.0]
+
+    def sample_memory():
+        while True:
+            peak_rss[0] = max(peak_rss[0], proc_status(server.pid)[0])
+            gevent.sleep(0.2)
+
+    try:
+        idle_rss = proc_status(server.pid)[0] if server else None
+        sampler = gevent.spawn(sample_memory) if server else None
+        started = time.perf_counter()
+        rooms = [gevent.spawn(run_room, url, i, args.cycles, args.candidates, results) for i in range(args.rooms)]
+        gevent.joinall(rooms)
+        elapsed = time.perf_counter() - started
+        if sampler:
+            sampler.kill()
+        failed = [room.exception for room in rooms if room.exception]
+        gevent.joinall(results['disconnects'], timeout=30)
+    finally:
+        if server:
+            server.kill()
+            server.wait()
+
+    print(f"{args.rooms} rooms x {args.cycles} cycles, {args.candidates} candidates per side, "
+          f"ice batch {args.ice_batch_ms} ms, {elapsed:.1f} s, {len(failed)} rooms failed")
+    if failed:
+        print(f"  first failure: {failed[0]!r}")
+    print(f"connect ms        {percentiles(results['connect_ms'])}")
+    print(f"offer/answer ms   {percentiles(results['negotiate_ms'])}")
+    print(f"call setup ms     {percentiles(results['setup_ms'])}")
+    print(f"relay throughput  {results['relayed'] / elapsed:8.0f} messages/s delivered ({results['relayed']} total)")
+    if idle_rss is not None:
+        print(f"server memory     idle {idle_rss:.1f} MB, peak {peak_rss[0]:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Gunicorn configuration for wsgi:app (REST API + WebRTC signaling).
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Reload code gracefully with `kill -HUP <master pid>`: new workers are started and old
+ones finish their in-flight requests (up to graceful_timeout) before exiting.
+
+Socket.IO needs every request of a client to reach the same worker. More than one
+worker is only safe with SIGNALING_REDIS_URL set (shared rooms and message queue) and
+with sticky sessions at the load balancer, or with clients that use the websocket
+transport only.
+"""
+import os
+
+# Signaling async mode decides the worker class; the app reads the same variable
+SIGNALING_ASYNC_MODE = os.environ.setdefault('SIGNALING_ASYNC_MODE', 'gevent')
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+if SIGNALING_ASYNC_MODE in ('gevent', 'eventlet'):
+    worker_class = SIGNALING_ASYNC_MODE
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 2000))
+else:
+    # threading: one OS thread per open socket
+    worker_class = 'gthread'
+    threads = int(os.getenv('GUNICORN_THREADS', 100))
+
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+
+# Off by default: the app opens its MongoClient and image worker pool at import time,
+# and neither may be shared across fork()
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+if preload_app and SIGNALING_ASYNC_MODE == 'gevent':
+    # The app is imported in the master, so patch before it is
+    from gevent import monkey
+    monkey.patch_all()
+
+# Long-polling requests are held open for up to the Socket.IO ping interval
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,456 @@
+"""
+Image compression and the background worker pool that runs it.
+
+Decoding, resizing and JPEG-encoding a photo is CPU-bound and can take seconds, so
+upload_image() only spools the upload to disk and hands it to a process pool here.
+The worker writes the compressed file into the upload folder and the caller is told
+through the future's done-callback.
+"""
+import io
+import math
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+from PIL import Image, UnidentifiedImageError
+
+load_dotenv()
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', max((os.cpu_count() or 2) // 2, 1)))
+# Threads that run done-callbacks (storing the output can be a slow S3 upload)
+IMAGE_CALLBACK_THREADS = int(os.getenv('IMAGE_CALLBACK_THREADS', 4))
+
+# Decode limits, checked from the header before any pixels are decoded. Pillow's own
+# decompression-bomb guard is pinned to the same limit so workers can't be surprised.
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 50_000_000))
+MAX_IMAGE_DIMENSION = int(os.getenv('MAX_IMAGE_DIMENSION', 12_000))
+ACCEPTED_FORMATS = {'JPEG', 'PNG', 'GIF'}
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+_pool = None
+_callback_pool = None
+_pool_lock = threading.Lock()
+
+
+class ImageRejected(ValueError):
+    """Upload is not an accepted image or exceeds the decode limits"""
+
+
+def probe_image(path, max_pixels=MAX_IMAGE_PIXELS, max_dimension=MAX_IMAGE_DIMENSION):
+    """
+    Validate an image from its header alone (no pixel data is decoded)
+
+    Returns:
+        (format, (width, height))
+
+    Raises:
+        ImageRejected: not a JPEG/PNG/GIF, or larger than the configured limits
+    """
+    try:
+        with Image.open(path) as image:
+            fmt, size = image.format, image.size
+    except Image.DecompressionBombError:
+        raise ImageRejected(f"Image exceeds {max_pixels} pixels")
+    except Exception:
+        raise ImageRejected("File is not a readable image")
+
+    if fmt not in ACCEPTED_FORMATS:
+        raise ImageRejected(f"Unsupported image format: {fmt}")
+    if max(size) > max_dimension:
+        raise ImageRejected(f"Image dimensions {size[0]}x{size[1]} exceed {max_dimension}px")
+    if size[0] * size[1] > max_pixels:
+        raise ImageRejected(f"Image exceeds {max_pixels} pixels")
+    return fmt, size
+
+
+def _fit_size(size, max_dimension):
+    """Scale (width, height) down so the longer side is at most max_dimension"""
+    if max(size) <= max_dimension:
+        return size
+    ratio = max_dimension / max(size)
+    return tuple(max(int(dim * ratio), 1) for dim in size)
+
+
+def _flatten(image):
+    """Convert to RGB, compositing any transparency onto a white background"""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Create a white background
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def _encode(image, quality, stats, optimize=False):
+    started = time.perf_counter()
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=optimize)
+    stats['encodes'] += 1
+    stats['encode_ms'] += (time.perf_counter() - started) * 1000
+    return output
+
+
+def _quant_scale(quality):
+    """libjpeg's quantization table scaling for a quality setting (larger = coarser)"""
+    return 5000 / quality if quality < 50 else 200 - 2 * quality
+
+
+def _quality_for_scale(scale):
+    return 5000 / scale if scale > 100 else (200 - scale) / 2
+
+
+def _encode_to_size(image, max_bytes, quality, min_quality, stats):
+    """
+    Find a high JPEG quality in [min_quality, quality] whose output fits max_bytes
+
+    Probes the requested quality first (the common case is a single encode). Past that,
+    output size is modelled as proportional to the quantization scale ** -k (k starts at
+    0.4, typical for photos and screenshots, and is re-fitted from each pair of
+    measurements), and the next quality is predicted from the last measured size
+    instead of bisected. The search stops once an output fits within 10% of the budget
+    or the bracket between the best fit and the lowest failing quality is 5 steps or
+    less; a prediction at min_quality that still doesn't fit gives up.
+
+    Returns:
+        (BytesIO or None if even min_quality is too large, quality used, smallest size seen)
+    """
+    output = _encode(image, quality, stats, optimize=True)
+    size = output.tell()
+    if size <= max_bytes:
+        return output, quality, size
+
+    best = best_quality = None
+    high, last_quality, last_size, smallest = quality, quality, size, size
+    k = 0.4
+    while best is None or (high - best_quality > 5 and best.tell() < max_bytes * 0.9):
+        low = best_quality + 1 if best is not None else min_quality
+        if low >= high:
+            break
+        # Aim a little under the budget so the prediction usually fits first time
+        target_scale = _quant_scale(last_quality) * (last_size / (max_bytes * 0.95)) ** (1 / k)
+        q = min(max(round(_quality_for_scale(target_scale)), low), high - 1)
+        output = _encode(image, q, stats)
+        size = output.tell()
+        smallest = min(smallest, size)
+        if size <= max_bytes:
+            best, best_quality = output, q
+        else:
+            high = q
+            if q == min_quality:
+                return None, None, size
+        if size != last_size:
+            fitted = math.log(last_size / size) / math.log(_quant_scale(q) / _quant_scale(last_quality))
+            if 0.1 <= fitted <= 2:
+                k = fitted
+        last_quality, last_size = q, size
+    return best, best_quality, smallest
+
+
+def compress_image(image_file, max_size_mb=2, quality=85, max_dimension=1920, min_quality=30, stats=None):
+    """
+    Compress image file to reduce size while maintaining reasonable quality
+
+    JPEG sources are decoded straight at a reduced scale via draft mode when they are
+    larger than max_dimension, and the output quality is searched for rather than
+    stepped through, so most images cost one decode and one encode.
+
+    Args:
+        image_file: File object from request.files or an open binary file
+        max_size_mb: Maximum file size in MB (default: 2MB)
+        quality: JPEG quality (1-95, default: 85)
+        max_dimension: Maximum width or height (default: 1920px)
+        min_quality: Lowest quality tried before downscaling further (default: 30)
+        stats: Optional dict filled with encode counts and timings
+
+    Returns:
+        Compressed image as BytesIO object, file extension
+    """
+    stats = stats if stats is not None else {}
+    stats.update({'encodes': 0, 'encode_ms': 0.0})
+    started = time.perf_counter()
+    try:
+        # Open the image (header only, no pixels decoded yet)
+        image = Image.open(image_file)
+        stats['source_size'] = image.size
+
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still covers the target
+        target_size = _fit_size(image.size, max_dimension)
+        if image.format == 'JPEG' and target_size != image.size:
+            image.draft('RGB', target_size)
+        image.load()
+        stats['decoded_size'] = image.size
+        stats['decode_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+        # Convert RGBA to RGB if necessary (for JPEG compatibility)
+        image = _flatten(image)
+
+        # Resize whatever draft mode left above the target
+        if image.size != target_size:
+            image = image.resize(target_size, Image.Resampling.LANCZOS)
+
+        max_bytes = int(max_size_mb * 1024 * 1024)
+        output, used_quality, smallest = _encode_to_size(image, max_bytes, quality, min_quality, stats)
+
+        # Still too large even at min_quality: shrink in proportion to the overshoot and retry
+        for _ in range(2):
+            if output is not None:
+                break
+            scale = (max_bytes / smallest) ** 0.5 * 0.9
+            image = image.resize(_fit_size(image.size, int(max(image.size) * scale)), Image.Resampling.LANCZOS)
+            output, used_quality, smallest = _encode_to_size(image, max_bytes, quality, min_quality, stats)
+
+        if output is None:
+            # Last resort - smallest quality at the reduced size
+            output, used_quality = _encode(image, min_quality, stats), min_quality
+
+        stats.update({
+            'quality': used_quality,
+            'output_size': image.size,
+            'output_bytes': output.tell(),
+            'encode_ms': round(stats['encode_ms'], 1),
+            'total_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+        output.seek(0)
+        return output, 'jpg'
+
+    except Exception as e:
+        print(f"Error compressing image: {e}")
+        # Return original file if compression fails
+        image_file.seek(0)
+        filename = getattr(image_file, 'filename', None) or getattr(image_file, 'name', '')
+        original_extension = filename.rsplit('.', 1)[1].lower()
+        return image_file, original_extension
+
+
+def process_upload(src_path, dest_path):
+    """
+    Worker entry point: compress a spooled upload into dest_path for the storage backend
+
+    The spooled source is removed afterwards. If the image cannot be compressed the
+    original bytes are stored unchanged.
+
+    Returns:
+        dict with file_size, file_type, original_size, encode_stats and elapsed_ms
+    """
+    started = time.perf_counter()
+    original_size = os.path.getsize(src_path)
+    tmp_path = f"{dest_path}.part"
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    try:
+        with open(src_path, 'rb') as src:
+            encode_stats = {}
+            compressed_file, file_type = compress_image(src, stats=encode_stats)
+            with open(tmp_path, 'wb') as out:
+                if isinstance(compressed_file, io.BytesIO):
+                    out.write(compressed_file.getbuffer())
+                    compressed_file.close()
+                else:
+                    shutil.copyfileobj(compressed_file, out)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.remove(src_path)
+
+    return {
+        "file_size": os.path.getsize(dest_path),
+        "file_type": file_type,
+        "original_size": original_size,
+        "encode_stats": encode_stats,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+
+def get_pool():
+    """Process pool shared by this server process, created on first use"""
+    global _pool, _callback_pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        if _callback_pool is None:
+            _callback_pool = ThreadPoolExecutor(max_workers=IMAGE_CALLBACK_THREADS, thread_name_prefix="image-done")
+        return _pool
+
+
+def _replace_broken_pool(broken):
+    """Drop a pool whose worker died so the next get_pool() starts a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+def _run_callback(on_done, future):
+    try:
+        on_done(future)
+    except Exception as e:
+        print(f"Image upload callback failed: {e}")
+
+
+def submit_upload(src_path, dest_path, on_done):
+    """
+    Queue process_upload() on the worker pool; on_done(future) runs when it finishes
+
+    on_done runs on a callback thread rather than the pool's result-handling thread, so
+    a slow callback doesn't hold up completion of other jobs.
+    """
+    pool = get_pool()
+    try:
+        future = pool.submit(process_upload, src_path, dest_path)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed decoding a huge image) and took the pool with it
+        print("Image worker pool is broken, starting a new one")
+        _replace_broken_pool(pool)
+        future = get_pool().submit(process_upload, src_path, dest_path)
+    future.add_done_callback(lambda done: _callback_pool.submit(_run_callback, on_done, done))
+    return future
+
+
+class VariantCache:
+    """
+    Width-bucketed resized copies of uploaded images, generated on first request
+
+    Variants live in a single directory bounded to max_bytes. A cache hit bumps the
+    file's mtime, and when the directory grows past the bound the least recently used
+    variants are deleted until it is back under 90% of it.
+
+    Every server process adds to the same directory, so the size counted in-process is
+    only trusted for RESCAN_INSERTS inserts or RESCAN_SECONDS; after that the directory
+    is measured again, which picks up what the other processes wrote.
+    """
+
+    WIDTHS = (64, 128, 256, 512, 1024)
+    FORMATS = {'jpeg': ('JPEG', 'jpg'), 'webp': ('WEBP', 'webp')}
+    RESCAN_INSERTS = 64
+    RESCAN_SECONDS = 60
+
+    def __init__(self, cache_dir, max_bytes, widths=WIDTHS, quality=80):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.widths = tuple(sorted(widths))
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self._inserts_since_scan = 0
+        self._scanned_at = 0.0
+
+    def bucket(self, width):
+        """Smallest bucket that covers width, or None when the original should be served"""
+        for bucket in self.widths:
+            if width <= bucket:
+                return bucket
+        return None
+
+    def get(self, source, filename, width, fmt='jpeg'):
+        """
+        Path of the variant of filename at the bucket for width, creating it if needed
+
+        Args:
+            source: Path of the original, or a callable returning it as an open binary
+                file (only called on a cache miss)
+
+        Returns:
+            (path, mimetype) or None if the original is no wider than the bucket or
+            can't be decoded
+        """
+        bucket = self.bucket(width)
+        if bucket is None:
+            return None
+        pil_format, extension = self.FORMATS[fmt]
+        variant_path = os.path.join(self.cache_dir, f"{filename.rsplit('.', 1)[0]}.w{bucket}.{extension}")
+        mimetype = f"image/{fmt}"
+
+        try:
+            os.utime(variant_path)  # cache hit: mark as recently used
+            return variant_path, mimetype
+        except FileNotFoundError:
+            pass
+
+        tmp_path = f"{variant_path}.{os.getpid()}.{threading.get_ident()}.part"
+        with (source() if callable(source) else open(source, 'rb')) as src:
+            try:
+                with Image.open(src) as image:
+                    if image.width <= bucket:
+                        return None
+                    # draft() lets JPEG sources decode at a fraction of full size
+                    image.draft('RGB', (bucket, image.height * bucket // image.width))
+                    if fmt == 'webp' and image.mode in ('RGBA', 'LA', 'P'):
+                        image = image.convert('RGBA')  # WebP keeps transparency
+                    else:
+                        image = _flatten(image)
+                    image.thumbnail((bucket, image.height * bucket // image.width + 1), Image.Resampling.LANCZOS)
+
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    image.save(tmp_path, format=pil_format, quality=self.quality)
+            except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+                # Not an image (e.g. a PDF), truncated, or too large to decode: the
+                # original is served as is
+                print(f"No variant for {filename}: {e}")
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                return None
+        os.replace(tmp_path, variant_path)
+        self._added(os.path.getsize(variant_path))
+        return variant_path, mimetype
+
+    def discard(self, filename):
+        """Delete every cached variant of filename (e.g. once the original is gone)"""
+        prefix = f"{filename.rsplit('.', 1)[0]}.w"
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name.startswith(prefix):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self._total_bytes = None  # rescanned on the next insert
+
+    def _added(self, size):
+        with self._lock:
+            self._inserts_since_scan += 1
+            if (self._total_bytes is None or self._inserts_since_scan >= self.RESCAN_INSERTS
+                    or time.monotonic() - self._scanned_at >= self.RESCAN_SECONDS):
+                self._total_bytes = self._scan_size()
+                self._inserts_since_scan = 0
+                self._scanned_at = time.monotonic()
+            else:
+                self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._total_bytes = self._evict(int(self.max_bytes * 0.9))
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+
+    def _evict(self, target_bytes):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith('.part'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass  # evicted concurrently by another worker
+        return total
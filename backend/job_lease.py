@@ -0,0 +1,47 @@
+"""
+Leases that keep periodic background jobs to one process at a time.
+
+Every API process (each gunicorn worker, on every host) starts the same background
+threads, so before each run a job takes a named lease in the `job_leases` collection.
+The holder renews it on each run; when it dies, the lease expires and another process
+takes the job over.
+"""
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+
+def acquire_lease(db, name, ttl_seconds, owner=None):
+    """
+    Take or renew the lease called name for ttl_seconds
+
+    Args:
+        owner: Holder id, by default this host and process id (taken per call, so
+            workers forked from a preloaded app don't share it)
+
+    Returns:
+        True if this process now holds the lease, False if another process does
+    """
+    owner = owner or _default_owner()
+    now = datetime.now(timezone.utc)
+    try:
+        db.job_leases.update_one(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The lease exists, is held by someone else and has not expired
+        return False
+    return True
+
+
+def release_lease(db, name, owner=None):
+    """Give up the lease called name early, if this process (or owner) holds it"""
+    db.job_leases.delete_one({"_id": name, "owner": owner or _default_owner()})
+
+
+def _default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
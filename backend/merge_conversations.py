@@ -0,0 +1,113 @@
+"""
+One-off merge of duplicate conversations.
+
+Concurrent start_conversation calls used to create several conversations for the same
+doctor/patient pair. Those duplicates block the unique doctor_patient_pair index the
+API creates at startup (it logs an error and carries on without it). This folds each
+group of duplicates into its oldest conversation and then creates the index.
+
+Run once, ideally while no API process is writing messages:
+    python merge_conversations.py [--dry-run]
+Only one run at a time merges, see job_lease.py.
+"""
+import argparse
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from job_lease import acquire_lease, release_lease
+
+load_dotenv()
+
+# Long enough for the merge of a large collection; released early when it finishes
+MERGE_LEASE_SECONDS = 3600
+
+
+def ensure_pair_index(db):
+    """One conversation per doctor/patient pair; start_conversation upserts on this key"""
+    db.conversations.create_index(
+        [("doctor_email", 1), ("patient_email", 1)],
+        unique=True,
+        name="doctor_patient_pair"
+    )
+
+
+def find_duplicate_groups(db):
+    """The _ids of each doctor/patient pair that has more than one conversation"""
+    return [group["ids"] for group in db.conversations.aggregate([
+        {"$group": {
+            "_id": {"doctor_email": "$doctor_email", "patient_email": "$patient_email"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)]
+
+
+def merge_duplicate_conversations(db):
+    """
+    Fold conversations that share a doctor/patient pair into the oldest one
+
+    Messages (hot and archived) move to the kept conversation, unread counts are added
+    up and the latest last_message wins. The kept conversation's key exchange is
+    preserved; a duplicate's key only fills a role it has none for.
+
+    Returns:
+        number of duplicate conversations removed
+    """
+    removed = 0
+    for ids in find_duplicate_groups(db):
+        convs = list(db.conversations.find({"_id": {"$in": ids}}).sort("_id", 1))
+        keeper, extras = convs[0], convs[1:]
+        extra_ids = [conv["_id"] for conv in extras]
+
+        db.messages.update_many({"conversation_id": {"$in": extra_ids}}, {"$set": {"conversation_id": keeper["_id"]}})
+        db.messages_archive.update_many({"conversation_id": {"$in": extra_ids}}, {"$set": {"conversation_id": keeper["_id"]}})
+
+        latest = max(convs, key=lambda conv: conv.get("last_message_time") or datetime.min)
+        merged = {
+            "last_message": latest.get("last_message", ""),
+            "last_message_time": latest.get("last_message_time"),
+            "unread_count_doctor": sum(conv.get("unread_count_doctor", 0) for conv in convs),
+            "unread_count_patient": sum(conv.get("unread_count_patient", 0) for conv in convs)
+        }
+        keys = dict(keeper.get("dh_keys", {}))
+        for conv in extras:
+            for role, key in conv.get("dh_keys", {}).items():
+                keys.setdefault(role, key)
+        if keys:
+            merged["dh_keys"] = keys
+        db.conversations.update_one({"_id": keeper["_id"]}, {"$set": merged})
+        db.conversations.delete_many({"_id": {"$in": extra_ids}})
+        removed += len(extras)
+    return removed
+
+
+def main():
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Merge duplicate conversations and create the unique pair index")
+    parser.add_argument("--dry-run", action="store_true", help="Report the duplicates without merging")
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv('MONGO_URI')).mediconnect
+    if args.dry_run:
+        groups = find_duplicate_groups(db)
+        print(f"{len(groups)} doctor/patient pairs have {sum(len(ids) - 1 for ids in groups)} duplicate conversations")
+        return
+
+    # A second concurrent run would add the same unread counts up again
+    if not acquire_lease(db, "merge-conversations", MERGE_LEASE_SECONDS):
+        print("Another merge is running, exiting")
+        return
+    try:
+        print(f"Merged {merge_duplicate_conversations(db)} duplicate conversations")
+        ensure_pair_index(db)
+        print("Created the doctor_patient_pair index")
+    finally:
+        release_lease(db, "merge-conversations")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Hot/cold tiering for chat messages.
+
+Messages older than ARCHIVE_AFTER_DAYS are moved out of the `messages` collection
+into `messages_archive` as zlib-compressed BSON chunks (one document per run of up to
+ARCHIVE_CHUNK_SIZE messages of a single conversation). The hot collection and its
+indexes then only hold recent history, and get_messages() pages into the cold tier
+only when a client scrolls back past the oldest hot message.
+
+Run periodically (e.g. from cron):
+    python message_archive.py [--days 90]
+"""
+import argparse
+import os
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import bson
+from bson import Binary
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', 500))
+
+
+def ensure_archive_indexes(db):
+    """Index used to walk a conversation's cold chunks newest-first"""
+    db.messages_archive.create_index(
+        [("conversation_id", 1), ("last_ts", -1)],
+        name="conversation_last_ts"
+    )
+
+
+def encode_cursor(msg):
+    """Opaque paging cursor for a message: '<timestamp ms>_<message id>'"""
+    ts = msg['timestamp'].replace(tzinfo=timezone.utc)
+    return f"{int(ts.timestamp() * 1000)}_{msg['_id']}"
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); returns (naive UTC datetime, ObjectId)"""
+    ts_ms, msg_id = cursor.split('_', 1)
+    ts = datetime.fromtimestamp(int(ts_ms) / 1000, timezone.utc).replace(tzinfo=None)
+    return ts, bson.ObjectId(msg_id)
+
+
+def _sort_key(msg):
+    return (msg['timestamp'], msg['_id'])
+
+
+def _compress(messages):
+    return Binary(zlib.compress(bson.encode({"messages": messages}), 6))
+
+
+def _decompress(data):
+    return bson.decode(zlib.decompress(data))["messages"]
+
+
+def archive_conversation(db, conversation_id, cutoff, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Move one conversation's messages older than cutoff into compressed chunks"""
+    archived = 0
+    while True:
+        batch = list(db.messages.find(
+            {"conversation_id": conversation_id, "timestamp": {"$lt": cutoff}}
+        ).sort([("timestamp", 1), ("_id", 1)]).limit(chunk_size))
+        if not batch:
+            return archived
+
+        file_ids = sorted({
+            m['image_attachment']['file_id']
+            for m in batch
+            if m.get('image_attachment') and m['image_attachment'].get('file_id')
+        })
+        chunk = {
+            # Keyed by the first message id so a re-run after a crash overwrites, not duplicates
+            "_id": batch[0]['_id'],
+            "conversation_id": conversation_id,
+            "first_ts": batch[0]['timestamp'],
+            "last_ts": batch[-1]['timestamp'],
+            "count": len(batch),
+            # Kept uncompressed so the upload GC can see which files are still referenced
+            "file_ids": file_ids,
+            "data": _compress(batch),
+            "archived_at": datetime.now(timezone.utc)
+        }
+        db.messages_archive.replace_one({"_id": chunk["_id"]}, chunk, upsert=True)
+        db.messages.delete_many({"_id": {"$in": [m['_id'] for m in batch]}})
+        archived += len(batch)
+
+
+def archive_old_messages(db, max_age_days=ARCHIVE_AFTER_DAYS, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Archive every message older than max_age_days; returns the number moved"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    ensure_archive_indexes(db)
+
+    total = 0
+    for conversation_id in db.messages.distinct("conversation_id", {"timestamp": {"$lt": cutoff}}):
+        moved = archive_conversation(db, conversation_id, cutoff, chunk_size)
+        print(f"Archived {moved} messages from conversation {conversation_id}")
+        total += moved
+    return total
+
+
+def has_archived_messages(db, conversation_id):
+    return db.messages_archive.find_one({"conversation_id": conversation_id}, {"_id": 1}) is not None
+
+
+def load_archived_messages(db, conversation_id, before=None, limit=50):
+    """
+    Read up to `limit` archived messages older than `before`, newest first
+
+    Args:
+        before: (timestamp, ObjectId) tuple from decode_cursor(), or None for the newest
+        limit: Maximum number of messages to return
+
+    Returns:
+        (messages newest-first, whether older archived messages remain)
+    """
+    query = {"conversation_id": conversation_id}
+    if before:
+        query["first_ts"] = {"$lte": before[0]}
+
+    result = []
+    chunks = db.messages_archive.find(query, {"data": 1}).sort("last_ts", -1)
+    for chunk in chunks:
+        messages = sorted(_decompress(chunk['data']), key=_sort_key, reverse=True)
+        if before:
+            messages = [m for m in messages if _sort_key(m) < before]
+        for msg in messages:
+            if len(result) == limit:
+                chunks.close()
+                return result, True
+            result.append(msg)
+    return result, False
+
+
+def main():
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Move old chat messages into the compressed cold tier")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="Archive messages older than this many days")
+    parser.add_argument("--chunk-size", type=int, default=ARCHIVE_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv('MONGO_URI')).mediconnect
+    total = archive_old_messages(db, args.days, args.chunk_size)
+    print(f"Archived {total} messages older than {args.days} days")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import datetime
 from flask import Blueprint, jsonify, redirect, request, current_app
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from dotenv import load_dotenv
@@ -12,6 +13,8 @@ from dateutil.parser import isoparse
 import base64
 import json
 import traceback
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 
 load_dotenv()
 google_calendar = Blueprint("google_calendar", __name__)
@@ -20,6 +23,15 @@ os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 CLIENT_SECRETS_FILE = os.getenv("GOOGLE_CLIENT_SECRET_FILE")
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 REDIRECT_URI = "http://localhost:5000/google/callback"
+# Busy times are synced for events ending after now and starting within the look-ahead
+GOOGLE_SYNC_LOOKAHEAD_DAYS = float(os.getenv("GOOGLE_SYNC_LOOKAHEAD_DAYS", 180))
+# A token sync is replaced by a full one once the window has moved this far past the
+# end of the window the last full sync listed
+GOOGLE_SYNC_WINDOW_SLACK_HOURS = float(os.getenv("GOOGLE_SYNC_WINDOW_SLACK_HOURS", 24))
+# Events per API page (Google allows up to 2500)
+GOOGLE_SYNC_PAGE_SIZE = int(os.getenv("GOOGLE_SYNC_PAGE_SIZE", 250))
+# Partial response: only the event fields the busy-time sync reads
+SYNC_FIELDS = "nextPageToken,nextSyncToken,items(id,status,summary,start,end)"
 
 
 # Login 
@@ -76,7 +88,8 @@ def google_callback():
         db = current_app.db
         db.users.update_one(
             {"_id": ObjectId(doctor_id)},
-            {"$set": {"googleToken": token_data}}
+            # A sync token belongs to the previously connected calendar
+            {"$set": {"googleToken": token_data}, "$unset": {"googleSyncToken": "", "googleSyncWindowEnd": ""}}
         )
 
         return redirect(f"http://localhost:3000/oauth-success?token={jwt_token}&doctorId={doctor_id}")
@@ -109,51 +122,201 @@ def sync_google_busy():
         creds = dict_to_credentials(user["googleToken"])
         service = build('calendar', 'v3', credentials=creds)
 
-        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
-        events_result = service.events().list(
-            calendarId='primary',
-            timeMin=now,
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
-        print(f"Fetched {len(events)} Google Calendar events")
-
-        busy_slots = []
-        for event in events:
-            start = event['start'].get('dateTime') or event['start'].get('date')
-            end = event['end'].get('dateTime') or event['end'].get('date')
-
-            if not start or not end:
-                continue
-
-            busy_slot = {
-                "doctorId": doctor_id,
-                "startTime": isoparse(start).astimezone().isoformat(),
-                "endTime": isoparse(end).astimezone().isoformat(),
-                "reason": event.get("summary", "Google Calendar Event"),
-                "createdAt": datetime.datetime.now(datetime.timezone.utc),
-                "updatedAt": datetime.datetime.now(datetime.timezone.utc)
-            }
-
-            # Avoid duplicates
-            if not db.doctor_busy_time.find_one({
-                "doctorId": doctor_id,
-                "startTime": busy_slot["startTime"],
-                "endTime": busy_slot["endTime"]
-            }):
-                busy_slots.append(busy_slot)
-
-        if busy_slots:
-            db.doctor_busy_time.insert_many(busy_slots)
-
-        return jsonify({"message": f"{len(busy_slots)} busy slots synced."}), 200
+        added, updated, removed = sync_busy_slots(
+            db, doctor_id, service, user.get("googleSyncToken"), user.get("googleSyncWindowEnd")
+        )
+
+        return jsonify({
+            "message": f"{added + updated} busy slots synced.",
+            "added": added,
+            "updated": updated,
+            "removed": removed
+        }), 200
 
     except Exception as e:
         print("Google Sync Failed:\n", traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
 
+def ensure_calendar_indexes(db):
+    """One busy slot per Google event and doctor, so sync can upsert instead of checking first"""
+    # Busy times added by hand have no googleEventId and stay out of the index
+    db.doctor_busy_time.create_index(
+        [("doctorId", 1), ("googleEventId", 1)],
+        unique=True,
+        partialFilterExpression={"googleEventId": {"$exists": True}},
+        name="doctor_google_event"
+    )
+
+
+def sync_busy_slots(db, doctor_id, service, sync_token=None, window_end=None):
+    """
+    Mirror the doctor's Google Calendar events into doctor_busy_time
+
+    With the sync token saved by the previous sync only the events changed since then
+    are fetched. Without one, once Google has invalidated it (410 Gone), or once the
+    lookahead window has moved more than GOOGLE_SYNC_WINDOW_SLACK_HOURS past window_end
+    (the end of the window the last full sync listed), all events in the next
+    GOOGLE_SYNC_LOOKAHEAD_DAYS are listed and busy slots of events no longer listed are
+    removed. Either way the listing is read page by page.
+
+    Returns:
+        (added, updated, removed) busy slot counts
+    """
+    if sync_token and not window_moved(window_end):
+        try:
+            return run_sync(db, doctor_id, service, sync_token)
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            print(f"Google sync token expired for doctorId {doctor_id}, running a full sync")
+            db.users.update_one(
+                {"_id": ObjectId(doctor_id)},
+                {"$unset": {"googleSyncToken": "", "googleSyncWindowEnd": ""}}
+            )
+    elif sync_token:
+        # Unchanged events that were past the old window never show up in an incremental
+        # listing, so they are only picked up by listing the new window in full
+        print(f"Google sync window moved for doctorId {doctor_id}, running a full sync")
+
+    return run_sync(db, doctor_id, service, None)
+
+
+def window_moved(window_end):
+    """Whether the lookahead window now ends more than the slack past window_end"""
+    if window_end is None:
+        return True
+    if window_end.tzinfo is None:
+        # Read back from MongoDB as naive UTC
+        window_end = window_end.replace(tzinfo=datetime.timezone.utc)
+    time_max = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=GOOGLE_SYNC_LOOKAHEAD_DAYS)
+    return time_max - window_end > datetime.timedelta(hours=GOOGLE_SYNC_WINDOW_SLACK_HOURS)
+
+
+def run_sync(db, doctor_id, service, sync_token):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    time_max = now + datetime.timedelta(days=GOOGLE_SYNC_LOOKAHEAD_DAYS)
+    params = {
+        "calendarId": "primary",
+        "singleEvents": True,
+        "maxResults": GOOGLE_SYNC_PAGE_SIZE,
+        "fields": SYNC_FIELDS
+    }
+    if sync_token:
+        # Incremental: cancelled events are always included; time filters are not allowed
+        params["syncToken"] = sync_token
+    else:
+        params.update(timeMin=now.isoformat(), timeMax=time_max.isoformat(), showDeleted=True)
+
+    added = updated = removed = fetched = 0
+    next_sync_token = None
+    # Each page is written before the next is fetched; only the last one has nextSyncToken
+    for page in list_event_pages(service, params):
+        events = page.get('items', [])
+        fetched += len(events)
+        operations = [op for op in (busy_slot_operation(doctor_id, event, now, time_max) for event in events) if op]
+        page_added, page_updated, page_removed = write_busy_slots(db, operations)
+        added += page_added
+        updated += page_updated
+        removed += page_removed
+        next_sync_token = page.get('nextSyncToken')
+    print(f"Fetched {fetched} Google Calendar events")
+
+    if not sync_token:
+        # A complete full listing: every synced slot it did not touch is gone from the calendar
+        removed += db.doctor_busy_time.delete_many({
+            "doctorId": doctor_id,
+            "googleEventId": {"$exists": True},
+            # Missing on slots written before syncedAt was recorded
+            "syncedAt": {"$not": {"$gte": now}}
+        }).deleted_count
+        # Slots synced before googleEventId was recorded, now duplicated by keyed ones. Only
+        # the sync stored a string doctorId and ISO-string times (add_doctor_busy_time
+        # stores an ObjectId and dates), so hand-entered busy times are not matched.
+        db.doctor_busy_time.delete_many({
+            "doctorId": doctor_id,
+            "googleEventId": {"$exists": False},
+            "startTime": {"$type": "string"}
+        })
+
+    if not sync_token and next_sync_token:
+        db.users.update_one({"_id": ObjectId(doctor_id)}, {"$set": {
+            "googleSyncToken": next_sync_token,
+            "googleSyncWindowEnd": time_max
+        }})
+    elif next_sync_token and next_sync_token != sync_token:
+        db.users.update_one({"_id": ObjectId(doctor_id)}, {"$set": {"googleSyncToken": next_sync_token}})
+
+    return added, updated, removed
+
+
+def list_event_pages(service, params):
+    """Yield the responses of events().list(**params), following nextPageToken to the last page"""
+    page_token = None
+    while True:
+        if page_token:
+            page = service.events().list(pageToken=page_token, **params).execute()
+        else:
+            page = service.events().list(**params).execute()
+        yield page
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            return
+
+
+def busy_slot_operation(doctor_id, event, now, time_max):
+    """The bulk write operation that applies one Google event, or None to skip it"""
+    key = {"doctorId": doctor_id, "googleEventId": event["id"]}
+    if event.get("status") == "cancelled":
+        return DeleteOne(key)
+
+    start = event.get('start', {}).get('dateTime') or event.get('start', {}).get('date')
+    end = event.get('end', {}).get('dateTime') or event.get('end', {}).get('date')
+    if not start or not end:
+        return None
+
+    start_time = isoparse(start).astimezone()
+    end_time = isoparse(end).astimezone()
+    if end_time <= now or start_time >= time_max:
+        # Outside the window (incremental syncs can't filter by time): drop any slot it had
+        return DeleteOne(key)
+
+    return UpdateOne(key, {
+        "$set": {
+            "startTime": start_time.isoformat(),
+            "endTime": end_time.isoformat(),
+            "reason": event.get("summary", "Google Calendar Event"),
+            "updatedAt": now
+        },
+        # A sync that started earlier and finishes later must not move it back, or the
+        # later sync's prune would delete slots it just wrote
+        "$max": {"syncedAt": now},
+        "$setOnInsert": {"createdAt": now}
+    }, upsert=True)
+
+
+def write_busy_slots(db, operations):
+    """Apply the operations in one unordered bulk write; returns (added, updated, removed)"""
+    if not operations:
+        return 0, 0, 0
+
+    try:
+        result = db.doctor_busy_time.bulk_write(operations, ordered=False)
+        return result.upserted_count, result.modified_count, result.deleted_count
+    except BulkWriteError as e:
+        details = e.details
+        # A concurrent sync inserted the same event first; retried, the upsert matches it
+        retry = [operations[error["index"]] for error in details["writeErrors"] if error["code"] == 11000]
+        if len(retry) < len(details["writeErrors"]):
+            raise
+        result = db.doctor_busy_time.bulk_write(retry, ordered=False)
+        return (
+            details["nUpserted"] + result.upserted_count,
+            details["nModified"] + result.modified_count,
+            details["nRemoved"] + result.deleted_count
+        )
+
+
 def credentials_to_dict(creds):
     return {
         'token': creds.token,
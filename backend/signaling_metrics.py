@@ -0,0 +1,129 @@
+"""
+In-process metrics for WebRTC signaling, rendered in the Prometheus text format.
+
+Counters, gauges and histograms live in this process only; with several workers,
+scrape each one (or run signaling on a single signaling_server.py process). An update
+is a dict lookup and an add under a lock, so instrumenting the relay path costs
+microseconds.
+"""
+import bisect
+import threading
+import time
+from functools import wraps
+
+# Handler latency buckets in seconds (0.5ms .. 1s)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    """Monotonic count per label value"""
+
+    def __init__(self, name, help_text, label='event'):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self.values.items())
+        lines += [f'{self.name}{{{self.label}="{label_value}"}} {value}' for label_value, value in values]
+        return lines
+
+
+class Gauge:
+    """Single value that goes up and down"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.value}"]
+
+
+class Histogram:
+    """Distribution of observed values per label value, over fixed buckets"""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, label='event'):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.values = {}  # label value -> [per-bucket counts (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(label_value)
+            if entry is None:
+                entry = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((label_value, list(counts), total) for label_value, (counts, total) in self.values.items())
+        for label_value, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {cumulative}')
+        return lines
+
+
+events = Counter('signaling_events_total', 'Signaling events handled')
+errors = Counter('signaling_errors_total', 'Signaling events answered with an error')
+latency = Histogram('signaling_event_duration_seconds', 'Time spent handling a signaling event')
+connected_sockets = Gauge('signaling_connected_sockets', 'Sockets connected to this process')
+ice_relayed = Counter('signaling_ice_total', 'ICE candidates received and frames emitted', label='kind')
+
+
+def instrument(event):
+    """Count calls to a Socket.IO handler and record how long each took"""
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                events.inc(event)
+                latency.observe(event, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def render(rooms, users):
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in (events, errors, latency, connected_sockets, ice_relayed):
+        lines += metric.render()
+    lines += [
+        "# HELP signaling_rooms Active signaling rooms",
+        "# TYPE signaling_rooms gauge",
+        f"signaling_rooms {rooms}",
+        "# HELP signaling_room_users Users in active signaling rooms",
+        "# TYPE signaling_room_users gauge",
+        f"signaling_room_users {users}"
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,204 @@
+"""
+Room registry for WebRTC signaling.
+
+Which users are in which consultation room has to be visible to every Socket.IO
+worker, otherwise two participants that land on different gunicorn workers (or hosts)
+never see each other. The registry is pluggable:
+
+    InMemoryRoomStore  state in this process only (single worker, development)
+    RedisRoomStore     state in Redis (or anything speaking the Redis protocol, e.g.
+                       a local fakeredis instance in tests), shared by all workers
+
+get_room_store() picks the Redis store when SIGNALING_REDIS_URL is set.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SIGNALING_REDIS_URL = os.getenv('SIGNALING_REDIS_URL')
+# Rooms left behind by a crashed worker expire after this long without a join
+SIGNALING_ROOM_TTL = int(os.getenv('SIGNALING_ROOM_TTL', 24 * 3600))
+
+
+class InMemoryRoomStore:
+    """Room state kept in a dict in this process"""
+
+    def __init__(self):
+        self.rooms = {}
+        # Reverse index: socket id -> ids of the rooms it is in
+        self.sid_rooms = {}
+        self._lock = threading.Lock()
+
+    def add_user(self, room_id, sid, user):
+        """
+        Add user (keyed by socket id) to room_id, creating the room if needed
+
+        Returns:
+            (whether the room was created, users now in the room)
+        """
+        with self._lock:
+            created = room_id not in self.rooms
+            if created:
+                self.rooms[room_id] = {
+                    'users': {},
+                    'created_at': datetime.now().isoformat(),
+                    'room_id': room_id
+                }
+            room = self.rooms[room_id]
+            room['users'][sid] = user
+            self.sid_rooms.setdefault(sid, set()).add(room_id)
+            return created, list(room['users'].values())
+
+    def remove_user(self, room_id, sid):
+        """
+        Remove sid from room_id, deleting the room once it is empty
+
+        Returns:
+            (removed user or None if sid wasn't in the room, remaining users, whether the room was deleted)
+        """
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if not room or sid not in room['users']:
+                return None, list(room['users'].values()) if room else [], False
+            user = room['users'].pop(sid)
+            sid_rooms = self.sid_rooms.get(sid)
+            if sid_rooms is not None:
+                sid_rooms.discard(room_id)
+                if not sid_rooms:
+                    del self.sid_rooms[sid]
+            deleted = not room['users']
+            if deleted:
+                del self.rooms[room_id]
+            return user, list(room['users'].values()), deleted
+
+    def room_exists(self, room_id):
+        return room_id in self.rooms
+
+    def has_user(self, room_id, sid):
+        room = self.rooms.get(room_id)
+        return room is not None and sid in room['users']
+
+    def rooms_for_sid(self, sid):
+        """Ids of the rooms sid is in"""
+        with self._lock:
+            return list(self.sid_rooms.get(sid, ()))
+
+    def get_room(self, room_id):
+        """{'room_id', 'created_at', 'users'} for room_id, or None"""
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if not room:
+                return None
+            return {'room_id': room_id, 'created_at': room['created_at'], 'users': list(room['users'].values())}
+
+    def all_rooms(self):
+        with self._lock:
+            return {
+                room_id: {'room_id': room_id, 'created_at': room['created_at'], 'users': list(room['users'].values())}
+                for room_id, room in self.rooms.items()
+            }
+
+
+class RedisRoomStore:
+    """
+    Room state in Redis, shared by every signaling worker
+
+    Each room is two hashes, `<prefix>:room:<id>:users` (socket id -> user JSON) and
+    `<prefix>:room:<id>:meta`, plus membership in the `<prefix>:rooms` set. The set
+    `<prefix>:sid:<socket id>` indexes the rooms each socket is in. The client must be
+    created with decode_responses=True.
+    """
+
+    def __init__(self, client, prefix='signaling', room_ttl=SIGNALING_ROOM_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.room_ttl = room_ttl
+        self.rooms_key = f"{prefix}:rooms"
+
+    def _users_key(self, room_id):
+        return f"{self.prefix}:room:{room_id}:users"
+
+    def _meta_key(self, room_id):
+        return f"{self.prefix}:room:{room_id}:meta"
+
+    def _sid_key(self, sid):
+        return f"{self.prefix}:sid:{sid}"
+
+    def add_user(self, room_id, sid, user):
+        users_key, meta_key = self._users_key(room_id), self._meta_key(room_id)
+        pipe = self.client.pipeline()
+        pipe.hsetnx(meta_key, 'created_at', datetime.now().isoformat())
+        pipe.hset(users_key, sid, json.dumps(user))
+        pipe.sadd(self.rooms_key, room_id)
+        pipe.sadd(self._sid_key(sid), room_id)
+        pipe.expire(users_key, self.room_ttl)
+        pipe.expire(meta_key, self.room_ttl)
+        pipe.expire(self._sid_key(sid), self.room_ttl)
+        pipe.hvals(users_key)
+        results = pipe.execute()
+        return bool(results[0]), [json.loads(value) for value in results[-1]]
+
+    def remove_user(self, room_id, sid):
+        users_key, meta_key = self._users_key(room_id), self._meta_key(room_id)
+
+        def remove(pipe):
+            # WATCH on users_key: a concurrent join makes this retry instead of
+            # deleting a room that just got a new member
+            users = pipe.hgetall(users_key)
+            raw = users.pop(sid, None)
+            remaining = [json.loads(value) for value in users.values()]
+            pipe.multi()
+            if raw is None:
+                return None, remaining, False
+            pipe.hdel(users_key, sid)
+            pipe.srem(self._sid_key(sid), room_id)
+            if not users:
+                pipe.delete(users_key, meta_key)
+                pipe.srem(self.rooms_key, room_id)
+            return json.loads(raw), remaining, not users
+
+        return self.client.transaction(remove, users_key, value_from_callable=True)
+
+    def room_exists(self, room_id):
+        return bool(self.client.exists(self._users_key(room_id)))
+
+    def has_user(self, room_id, sid):
+        return bool(self.client.hexists(self._users_key(room_id), sid))
+
+    def rooms_for_sid(self, sid):
+        return list(self.client.smembers(self._sid_key(sid)))
+
+    def get_room(self, room_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hget(self._meta_key(room_id), 'created_at')
+        pipe.hvals(self._users_key(room_id))
+        created_at, users = pipe.execute()
+        if not users:
+            return None
+        return {'room_id': room_id, 'created_at': created_at, 'users': [json.loads(value) for value in users]}
+
+    def all_rooms(self):
+        rooms = {}
+        for room_id in self.client.smembers(self.rooms_key):
+            room = self.get_room(room_id)
+            if room:
+                rooms[room_id] = room
+            else:
+                self.client.srem(self.rooms_key, room_id)  # expired
+        return rooms
+
+
+def get_room_store():
+    """Redis store when SIGNALING_REDIS_URL is set, otherwise in-memory"""
+    if not SIGNALING_REDIS_URL:
+        return InMemoryRoomStore()
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError("SIGNALING_REDIS_URL requires the redis package")
+    return RedisRoomStore(redis.Redis.from_url(SIGNALING_REDIS_URL, decode_responses=True))
@@ -0,0 +1,52 @@
+"""
+Standalone WebRTC signaling server.
+
+Runs only the Socket.IO signaling endpoints (no MongoDB, no REST API), so signaling
+can be scaled and deployed separately from app.py. With SIGNALING_ASYNC_MODE=gevent
+(or eventlet) each connected socket is a greenlet instead of an OS thread, which lets
+a single process hold thousands of idle consultation sockets.
+
+    SIGNALING_ASYNC_MODE=gevent python signaling_server.py
+    SIGNALING_ASYNC_MODE=gevent gunicorn -k gevent -w 1 signaling_server:app
+
+Set SIGNALING_REDIS_URL to run several of these behind a sticky-session load balancer.
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Monkey-patching has to happen before anything else imports socket/threading
+ASYNC_MODE = os.getenv('SIGNALING_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, jsonify  # noqa: E402
+from flask_cors import CORS  # noqa: E402
+
+from webrtc_signaling import init_webrtc_signaling, get_active_rooms  # noqa: E402
+
+app = Flask(__name__)
+app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+CORS(app)
+
+socketio = init_webrtc_signaling(app)
+
+
+@app.route('/health')
+def health():
+    return jsonify({"status": "ok", "async_mode": socketio.async_mode, "rooms": get_active_rooms()['total_rooms']})
+
+
+if __name__ == '__main__':
+    socketio.run(
+        app,
+        host=os.getenv('SIGNALING_HOST', '0.0.0.0'),
+        port=int(os.getenv('SIGNALING_PORT', 5001)),
+        allow_unsafe_werkzeug=True
+    )
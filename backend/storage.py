@@ -0,0 +1,231 @@
+"""
+Content-addressed storage for uploads.
+
+A stored upload is named after the SHA-256 of the bytes the client sent
+(`<sha256>.<ext>`), so uploading the same image twice resolves to the same file and is
+only stored and compressed once. Files nothing references any more are removed by
+upload_gc.py. Files are sharded two levels deep by hash prefix (`ab/cd/abcd....jpg`)
+so no single directory grows unbounded.
+
+Files uploaded before content addressing keep their flat `uuid_name.ext` names and
+are still resolved from the root of the upload folder.
+
+Where the bytes live is chosen by STORAGE_BACKEND:
+    local  files under UPLOAD_FOLDER (default)
+    s3     an S3-compatible bucket (AWS, MinIO, ...), configured with S3_BUCKET,
+           S3_PREFIX, S3_ENDPOINT_URL, S3_REGION and the usual AWS credentials
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 256 * 1024))
+
+_CONTENT_ID = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+
+
+class UploadTooLarge(ValueError):
+    """Upload stream is longer than the allowed size"""
+
+
+def is_content_id(file_id):
+    return bool(_CONTENT_ID.match(file_id))
+
+
+def content_id(digest, extension):
+    return f"{digest}.{extension}"
+
+
+def blob_path(root, file_id):
+    """Path of file_id under root (sharded for content ids, flat for legacy names)"""
+    if is_content_id(file_id):
+        return os.path.join(root, file_id[:2], file_id[2:4], file_id)
+    return os.path.join(root, file_id)
+
+
+def spool_upload(stream, directory, suffix='', chunk_size=CHUNK_SIZE, max_bytes=None):
+    """
+    Copy an upload stream to a temp file in directory, hashing it on the way
+
+    At most chunk_size bytes of the upload are held in memory at any time.
+
+    Raises:
+        UploadTooLarge: the stream is longer than max_bytes (the partial file is removed)
+
+    Returns:
+        (temp file path, size in bytes, sha256 hex digest)
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(dir=directory, suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, size, digest.hexdigest()
+
+
+class LocalStorage:
+    """Uploads kept on the local filesystem under root"""
+
+    is_local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, file_id):
+        """Filesystem path to serve file_id from, or None if it isn't stored"""
+        path = blob_path(self.root, file_id)
+        return path if os.path.isfile(path) else None
+
+    def exists(self, file_id):
+        return self.local_path(file_id) is not None
+
+    def save_file(self, file_id, src_path):
+        """Move a finished local file into storage (src_path is consumed)"""
+        dest = blob_path(self.root, file_id)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.move(src_path, dest)
+
+    def open(self, file_id):
+        return open(blob_path(self.root, file_id), 'rb')
+
+    def delete(self, file_id):
+        try:
+            os.remove(blob_path(self.root, file_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def download_url(self, file_id):
+        """Served by the app itself (see send_upload), so there is no external URL"""
+        return None
+
+    def iter_files(self):
+        """Yield (file_id, size, mtime) for every stored file"""
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('.'):
+                continue  # .incoming spool and .variants cache
+            if entry.is_file():
+                stat = entry.stat()
+                yield entry.name, stat.st_size, stat.st_mtime
+            elif entry.is_dir() and len(entry.name) == 2:
+                for dirpath, _, filenames in os.walk(entry.path):
+                    for name in filenames:
+                        if is_content_id(name):
+                            stat = os.stat(os.path.join(dirpath, name))
+                            yield name, stat.st_size, stat.st_mtime
+
+
+class S3Storage:
+    """Uploads kept in an S3-compatible bucket; downloads are redirected to presigned URLs"""
+
+    is_local = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, url_expiry=3600):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires the boto3 package")
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.url_expiry = url_expiry
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        # Files above 8MB go up as a streamed multipart upload in 8MB parts
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+
+    def key(self, file_id):
+        path = blob_path('', file_id).replace(os.sep, '/')
+        return f"{self.prefix}/{path}" if self.prefix else path
+
+    def local_path(self, file_id):
+        return None
+
+    def exists(self, file_id):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(file_id))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def save_file(self, file_id, src_path):
+        """Upload a finished local file (multipart when large) and remove the local copy"""
+        content_type = 'image/jpeg' if file_id.endswith('.jpg') else 'application/octet-stream'
+        self.client.upload_file(
+            src_path, self.bucket, self.key(file_id),
+            ExtraArgs={
+                'ContentType': content_type,
+                'CacheControl': 'public, max-age=31536000, immutable'
+            },
+            Config=self.transfer_config
+        )
+        os.remove(src_path)
+
+    def open(self, file_id):
+        """Download into a spooled temp file (seekable, so PIL can read it)"""
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(file_id))['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(file_id)
+        spooled = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        for chunk in body.iter_chunks(CHUNK_SIZE):
+            spooled.write(chunk)
+        spooled.seek(0)
+        return spooled
+
+    def delete(self, file_id):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(file_id))
+        return True
+
+    def download_url(self, file_id):
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self.key(file_id)},
+            ExpiresIn=self.url_expiry
+        )
+
+    def iter_files(self):
+        """Yield (file_id, size, mtime) for every stored object"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        prefix = f"{self.prefix}/" if self.prefix else ''
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'].rsplit('/', 1)[-1], obj['Size'], obj['LastModified'].timestamp()
+
+
+def get_storage(upload_folder):
+    """Storage backend selected by STORAGE_BACKEND"""
+    backend = os.getenv('STORAGE_BACKEND', 'local').lower()
+    if backend == 'local':
+        return LocalStorage(upload_folder)
+    if backend == 's3':
+        return S3Storage(
+            bucket=os.environ['S3_BUCKET'],
+            prefix=os.getenv('S3_PREFIX', 'uploads'),
+            endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+            region=os.getenv('S3_REGION'),
+            url_expiry=int(os.getenv('S3_URL_EXPIRY', 3600))
+        )
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
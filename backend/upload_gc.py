@@ -0,0 +1,182 @@
+"""
+Garbage collector for orphaned uploads.
+
+A stored file is orphaned when nothing references it any more: no message (hot or
+archived) has it as image_attachment.file_id and no doctor or patient profile has it as
+profilePhoto. That happens when an upload is never sent, or when a profile photo is
+replaced. The sweeper walks the storage backend in batches, looks each batch up with a
+handful of indexed $in queries, and deletes files that are unreferenced and older than
+the grace period (so uploads still waiting to be attached are left alone). It also
+removes spool files left in the upload folder's .incoming directory by image workers
+that crashed or were restarted mid-upload.
+
+Run once:
+    python upload_gc.py [--grace-hours 24] [--dry-run]
+or set UPLOAD_GC_INTERVAL_MINUTES to have the API processes sweep periodically (one
+at a time, see job_lease.py).
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from job_lease import acquire_lease
+
+load_dotenv()
+
+UPLOAD_GC_GRACE_HOURS = float(os.getenv('UPLOAD_GC_GRACE_HOURS', 24))
+UPLOAD_GC_BATCH_SIZE = int(os.getenv('UPLOAD_GC_BATCH_SIZE', 500))
+UPLOAD_GC_INTERVAL_MINUTES = float(os.getenv('UPLOAD_GC_INTERVAL_MINUTES', 0))
+# Same setting as the API's; by then an upload still processing is retried anyway
+UPLOAD_PROCESSING_TIMEOUT_SECONDS = int(os.getenv('UPLOAD_PROCESSING_TIMEOUT_SECONDS', 600))
+
+
+def ensure_gc_indexes(db):
+    """Indexes that make the per-batch reference lookups point queries"""
+    db.messages.create_index("image_attachment.file_id", sparse=True, name="attachment_file_id")
+    db.messages_archive.create_index("file_ids", name="archived_file_ids")
+    db.doctor_profiles.create_index("profilePhoto", sparse=True, name="profile_photo")
+    db.patient_profiles.create_index("profilePhoto", sparse=True, name="profile_photo")
+
+
+def _referenced(db, file_ids, cutoff):
+    """Subset of file_ids that something still points at (or that was uploaded recently)"""
+    query = {"$in": file_ids}
+    referenced = set(db.messages.distinct("image_attachment.file_id", {"image_attachment.file_id": query}))
+    referenced.update(db.messages_archive.distinct("file_ids", {"file_ids": query}))
+    referenced.update(db.doctor_profiles.distinct("profilePhoto", {"profilePhoto": query}))
+    referenced.update(db.patient_profiles.distinct("profilePhoto", {"profilePhoto": query}))
+    # An old file may have just been re-uploaded (deduplicated) and not attached yet
+    referenced.update(doc['_id'] for doc in db.uploads.find(
+        {"_id": query, "last_uploaded_at": {"$gte": cutoff}}, {"_id": 1}
+    ))
+    return referenced
+
+
+def collect_orphaned_uploads(db, file_store, variant_cache=None, grace_hours=UPLOAD_GC_GRACE_HOURS,
+                             batch_size=UPLOAD_GC_BATCH_SIZE, dry_run=False):
+    """
+    Delete stored files that nothing references and that are older than the grace period
+
+    Returns:
+        dict with scanned, deleted and reclaimed_bytes counts
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=grace_hours)
+    cutoff_ts = cutoff.timestamp()
+    report = {"scanned": 0, "deleted": 0, "reclaimed_bytes": 0, "dry_run": dry_run}
+
+    def sweep(batch):
+        referenced = _referenced(db, list(batch), cutoff)
+        for file_id, size in batch.items():
+            if file_id in referenced:
+                continue
+            if not dry_run:
+                # Delete the uploads doc first, unless a re-upload refreshed it since the
+                # lookup; files with no doc (legacy names, an earlier failed sweep) go anyway
+                claimed = db.uploads.delete_one(
+                    {"_id": file_id, "last_uploaded_at": {"$not": {"$gte": cutoff}}}
+                ).deleted_count == 1
+                if not claimed and db.uploads.find_one({"_id": file_id}, {"_id": 1}):
+                    continue
+                file_store.delete(file_id)
+                if variant_cache:
+                    variant_cache.discard(file_id)
+            report["deleted"] += 1
+            report["reclaimed_bytes"] += size
+
+    batch = {}
+    for file_id, size, mtime in file_store.iter_files():
+        report["scanned"] += 1
+        if mtime >= cutoff_ts:
+            continue
+        batch[file_id] = size
+        if len(batch) >= batch_size:
+            sweep(batch)
+            batch = {}
+    if batch:
+        sweep(batch)
+
+    print(f"Upload GC: scanned {report['scanned']} files, "
+          f"{'would delete' if dry_run else 'deleted'} {report['deleted']}, "
+          f"reclaimed {report['reclaimed_bytes'] / 1024 / 1024:.2f} MB")
+    return report
+
+
+def collect_stale_spool_files(incoming_folder, max_age_seconds=UPLOAD_PROCESSING_TIMEOUT_SECONDS):
+    """
+    Delete spool files in incoming_folder last written more than max_age_seconds ago
+
+    A spool (and the worker's .out file next to it) is removed once its upload has been
+    processed, but not when the worker pool broke or the process restarted meanwhile.
+
+    Returns:
+        number of files deleted
+    """
+    cutoff_ts = time.time() - max_age_seconds
+    deleted = 0
+    try:
+        entries = list(os.scandir(incoming_folder))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff_ts:
+                os.remove(entry.path)
+                deleted += 1
+        except FileNotFoundError:
+            pass  # finished (or swept by another process) meanwhile
+    if deleted:
+        print(f"Upload GC: deleted {deleted} stale spool files from {incoming_folder}")
+    return deleted
+
+
+def start_gc_thread(db, file_store, variant_cache=None, interval_minutes=UPLOAD_GC_INTERVAL_MINUTES,
+                    incoming_folder=None):
+    """
+    Sweep every interval_minutes on a daemon thread
+
+    Every API process starts this thread; a job lease makes only one of them sweep the
+    storage backend. The spool in incoming_folder is local to each host, so every process
+    sweeps it.
+    """
+    def run():
+        while True:
+            time.sleep(interval_minutes * 60)
+            try:
+                if incoming_folder:
+                    collect_stale_spool_files(incoming_folder)
+                if not acquire_lease(db, "upload-gc", interval_minutes * 60 * 1.5):
+                    continue
+                collect_orphaned_uploads(db, file_store, variant_cache)
+            except Exception as e:
+                print(f"Upload GC failed: {e}")
+
+    thread = threading.Thread(target=run, name="upload-gc", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    from pymongo import MongoClient
+    import storage
+
+    parser = argparse.ArgumentParser(description="Delete uploads that no message or profile references")
+    parser.add_argument("--grace-hours", type=float, default=UPLOAD_GC_GRACE_HOURS)
+    parser.add_argument("--batch-size", type=int, default=UPLOAD_GC_BATCH_SIZE)
+    parser.add_argument("--upload-folder", default='uploads')
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be deleted without deleting")
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv('MONGO_URI')).mediconnect
+    file_store = storage.get_storage(args.upload_folder)
+    collect_orphaned_uploads(db, file_store, grace_hours=args.grace_hours,
+                             batch_size=args.batch_size, dry_run=args.dry_run)
+    if not args.dry_run:
+        collect_stale_spool_files(os.path.join(args.upload_folder, '.incoming'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Lifecycle reaper for video sessions.
+
+A session stays `status: active` until someone calls end_video_session, so abandoned
+calls used to stay active forever. The reaper ends active sessions whose last_activity
+(peer registration, heartbeat, join) is older than VIDEO_SESSION_IDLE_MINUTES. Ended
+sessions are then deleted by a TTL index on ended_at after
+VIDEO_SESSION_RETENTION_DAYS.
+
+Run once:
+    python video_session_reaper.py [--idle-minutes 120]
+or let the API processes run it every VIDEO_REAPER_INTERVAL_MINUTES (0 disables); only
+one process at a time reaps, see job_lease.py.
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from pymongo.errors import OperationFailure
+
+from job_lease import acquire_lease
+
+load_dotenv()
+
+VIDEO_SESSION_IDLE_MINUTES = float(os.getenv('VIDEO_SESSION_IDLE_MINUTES', 120))
+VIDEO_SESSION_RETENTION_DAYS = float(os.getenv('VIDEO_SESSION_RETENTION_DAYS', 30))
+VIDEO_REAPER_INTERVAL_MINUTES = float(os.getenv('VIDEO_REAPER_INTERVAL_MINUTES', 5))
+
+
+def ensure_video_session_indexes(db, retention_days=VIDEO_SESSION_RETENTION_DAYS):
+    """Indexes for the active-session lookups and the reaper, plus the retention TTL"""
+    # create_video_session / get_appointment_video_session: {appointment_id, status: active}
+    db.video_sessions.create_index([("appointment_id", 1), ("status", 1)], name="appointment_status")
+    # The reaper: {status: active, last_activity < cutoff}
+    db.video_sessions.create_index([("status", 1), ("last_activity", 1)], name="status_last_activity")
+
+    # Only ended sessions have ended_at, so only they expire
+    expire_after = int(retention_days * 24 * 3600)
+    try:
+        db.video_sessions.create_index("ended_at", expireAfterSeconds=expire_after, name="ended_at_ttl")
+    except OperationFailure:
+        # The TTL index exists with another retention: change it in place
+        db.command('collMod', 'video_sessions', index={"keyPattern": {"ended_at": 1}, "expireAfterSeconds": expire_after})
+
+
+def reap_idle_sessions(db, idle_minutes=VIDEO_SESSION_IDLE_MINUTES):
+    """End active sessions idle for longer than idle_minutes; returns the ended session ids"""
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(minutes=idle_minutes)
+    idle = {
+        "status": "active",
+        "$or": [
+            {"last_activity": {"$lt": cutoff}},
+            # Sessions nobody ever joined
+            {"last_activity": {"$exists": False}, "created_at": {"$lt": cutoff}}
+        ]
+    }
+    session_ids = [doc['_id'] for doc in db.video_sessions.find(idle, {"_id": 1})]
+    if not session_ids:
+        return []
+
+    # Re-check status/activity in the update so a session resumed meanwhile is left alone
+    db.video_sessions.update_many(
+        {"_id": {"$in": session_ids}, **idle},
+        {
+            "$set": {"status": "ended", "ended_at": now, "ended_by": "system:idle", "peers": []}
+        }
+    )
+    print(f"Video reaper: ended {len(session_ids)} idle sessions")
+    return session_ids
+
+
+def start_reaper_thread(db, interval_minutes=VIDEO_REAPER_INTERVAL_MINUTES, on_reaped=None):
+    """
+    Reap every interval_minutes on a daemon thread
+
+    Every API process starts this thread; a job lease makes only one of them reap, so
+    on_reaped also runs once per reap.
+
+    Args:
+        on_reaped: Optional callback(session_ids) run after sessions were ended
+    """
+    def run():
+        while True:
+            time.sleep(interval_minutes * 60)
+            try:
+                if not acquire_lease(db, "video-session-reaper", interval_minutes * 60 * 1.5):
+                    continue
+                session_ids = reap_idle_sessions(db)
+                if session_ids and on_reaped:
+                    on_reaped(session_ids)
+            except Exception as e:
+                print(f"Video reaper failed: {e}")
+
+    thread = threading.Thread(target=run, name="video-session-reaper", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="End idle video sessions")
+    parser.add_argument("--idle-minutes", type=float, default=VIDEO_SESSION_IDLE_MINUTES)
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv('MONGO_URI')).mediconnect
+    ensure_video_session_indexes(db)
+    session_ids = reap_idle_sessions(db, args.idle_minutes)
+    print(f"Ended {len(session_ids)} video sessions idle for more than {args.idle_minutes} minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,68 @@
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from flask import request
+from flask import request, jsonify, Response
+import hmac
+import os
+import jwt
+import threading
 import uuid
 from datetime import datetime
+from bson import ObjectId
+from dotenv import load_dotenv
+from signaling_rooms import get_room_store, SIGNALING_REDIS_URL
+import signaling_metrics
 
-# Store room information
-rooms = {}
+load_dotenv()
+
+# threading costs one OS thread per connected socket; gevent or eventlet hold thousands
+# of idle sockets in one process (the process must be monkey-patched, see signaling_server.py)
+SIGNALING_ASYNC_MODE = os.getenv('SIGNALING_ASYNC_MODE', 'threading')
+
+# Socket.IO message queue used to fan emits out across workers/hosts (defaults to the room store's Redis)
+SIGNALING_MESSAGE_QUEUE = os.getenv('SIGNALING_MESSAGE_QUEUE', SIGNALING_REDIS_URL)
+
+# Coalesce trickle ICE: candidates from one sender are held this many ms (or until
+# end-of-candidates) and relayed as one 'ice-candidates' event. 0 relays each one.
+SIGNALING_ICE_BATCH_MS = int(os.getenv('SIGNALING_ICE_BATCH_MS', 0))
+
+# Bearer token for the admin rooms API (disabled when unset); also guards /metrics when set
+SIGNALING_ADMIN_TOKEN = os.getenv('SIGNALING_ADMIN_TOKEN')
+
+# Store room information (shared across workers when SIGNALING_REDIS_URL is set)
+room_store = get_room_store()
+
+# Per-room ICE relay counters for this process: candidates received, frames emitted
+ice_stats = {}
+ice_stats_lock = threading.Lock()
+
+def count_ice(room_id, candidates=0, frames=0):
+    with ice_stats_lock:
+        stats = ice_stats.setdefault(room_id, {'candidates': 0, 'frames': 0})
+        stats['candidates'] += candidates
+        stats['frames'] += frames
+    if candidates:
+        signaling_metrics.ice_relayed.inc('candidates', candidates)
+    if frames:
+        signaling_metrics.ice_relayed.inc('frames', frames)
+
+def video_session_room(session_id):
+    """Socket.IO room that receives a video session's state changes"""
+    return f"video_session:{session_id}"
+
+def video_session_state(session):
+    """JSON-safe view of a video session document, as pushed to subscribers"""
+    def iso(value):
+        return value.isoformat() if isinstance(value, datetime) else value
+
+    return {
+        'session_id': str(session['_id']),
+        'status': session.get('status'),
+        'room_id': session.get('room_id'),
+        'participants': [{k: iso(v) for k, v in p.items()} for p in session.get('participants', [])],
+        'peers': [{k: iso(v) for k, v in p.items()} for p in session.get('peers', [])],
+        'last_activity': iso(session.get('last_activity')),
+        'ended_at': iso(session.get('ended_at')),
+        'timestamp': datetime.now().isoformat()
+    }
 
 def init_webrtc_signaling(app):
     """Initialize WebRTC signaling with Socket.IO"""
@@ -13,13 +71,91 @@ def init_webrtc_signaling(app):
     socketio = SocketIO(
         app, 
         cors_allowed_origins="*",
-        async_mode='threading',
+        async_mode=SIGNALING_ASYNC_MODE,
+        message_queue=SIGNALING_MESSAGE_QUEUE,
         logger=False,
         engineio_logger=False
     )
     
+    def signal_error(event, message):
+        """Send an error to the calling socket and count it against event"""
+        signaling_metrics.errors.inc(event)
+        emit('error', {'message': message})
+
+    def relay(event, room_id, payload, to=None):
+        """
+        Send payload to peer `to` (a socket id in room_id), or to everyone else in room_id
+
+        Returns:
+            None, or an error message when the room or peer doesn't exist
+        """
+        if to:
+            if not room_store.has_user(room_id, to):
+                return 'Peer not found in room'
+            emit(event, payload, to=to)
+        else:
+            if not room_store.room_exists(room_id):
+                return 'Room not found'
+            emit(event, payload, room=room_id, include_self=False)
+        return None
+
+    # Pending ICE batches: (sender sid, room id, target sid or None) -> candidates
+    ice_batches = {}
+    ice_batches_lock = threading.Lock()
+
+    def flush_ice(key):
+        with ice_batches_lock:
+            candidates = ice_batches.pop(key, None)
+        if not candidates:
+            return
+        sender, room_id, to = key
+        payload = {
+            'candidates': candidates,
+            'from': sender,
+            'timestamp': datetime.now().isoformat()
+        }
+        if to:
+            socketio.emit('ice-candidates', payload, to=to)
+        else:
+            socketio.emit('ice-candidates', payload, room=room_id, skip_sid=sender)
+        count_ice(room_id, frames=1)
+
+    def flush_ice_later(key):
+        socketio.sleep(SIGNALING_ICE_BATCH_MS / 1000)
+        flush_ice(key)
+
+    def batch_ice(room_id, candidate, to=None):
+        """
+        Queue a candidate for the sender's current batch, starting one if needed
+
+        Returns:
+            None, or an error message when the room or peer doesn't exist
+        """
+        key = (request.sid, room_id, to)
+        with ice_batches_lock:
+            batch = ice_batches.get(key)
+            if batch is not None:
+                batch.append(candidate)
+        if batch is None:
+            # Only the first candidate of a batch pays for the room/peer lookup
+            if to and not room_store.has_user(room_id, to):
+                return 'Peer not found in room'
+            if not to and not room_store.room_exists(room_id):
+                return 'Room not found'
+            with ice_batches_lock:
+                ice_batches.setdefault(key, []).append(candidate)
+            socketio.start_background_task(flush_ice_later, key)
+        count_ice(room_id, candidates=1)
+
+        # A null/empty candidate marks end-of-candidates: nothing more is coming
+        if not candidate or not candidate.get('candidate'):
+            flush_ice(key)
+        return None
+
     @socketio.on('connect')
-    def handle_connect():
+    @signaling_metrics.instrument('connect')
+    def handle_connect(auth=None):
+        signaling_metrics.connected_sockets.inc()
         print(f'Client connected: {request.sid}')
         emit('connected', {
             'status': 'Connected to WebRTC signaling server',
@@ -28,31 +164,33 @@ def init_webrtc_signaling(app):
         })
 
     @socketio.on('disconnect')
+    @signaling_metrics.instrument('disconnect')
     def handle_disconnect():
+        signaling_metrics.connected_sockets.dec()
         print(f'Client disconnected: {request.sid}')
         
-        # Remove user from all rooms
-        for room_id, room_data in list(rooms.items()):
-            if request.sid in room_data['users']:
-                # Get user data before removing
-                user_data = room_data['users'][request.sid]
-                del room_data['users'][request.sid]
-                
-                print(f'Removed {user_data["name"]} from room {room_id}')
-                
-                # Notify others in room
-                socketio.emit('user-left', {
-                    'user': user_data,
-                    'users': list(room_data['users'].values()),
-                    'timestamp': datetime.now().isoformat()
-                }, room=room_id)
-                
-                # Clean up empty rooms
-                if len(room_data['users']) == 0:
-                    print(f'Cleaning up empty room: {room_id}')
-                    del rooms[room_id]
+        # Remove user from all rooms they joined
+        for room_id in room_store.rooms_for_sid(request.sid):
+            user_data, remaining, deleted = room_store.remove_user(room_id, request.sid)
+            if user_data is None:
+                continue
+
+            print(f'Removed {user_data["name"]} from room {room_id}')
+
+            # Notify others in room
+            socketio.emit('user-left', {
+                'user': user_data,
+                'users': remaining,
+                'timestamp': datetime.now().isoformat()
+            }, room=room_id)
+
+            # Empty rooms are cleaned up by the store
+            if deleted:
+                print(f'Cleaning up empty room: {room_id}')
+                ice_stats.pop(room_id, None)
 
     @socketio.on('join-room')
+    @signaling_metrics.instrument('join-room')
     def handle_join_room(data):
         try:
             room_id = data['roomId']
@@ -64,47 +202,41 @@ def init_webrtc_signaling(app):
             # Join the room
             join_room(room_id)
             
-            # Initialize room if doesn't exist
-            if room_id not in rooms:
-                rooms[room_id] = {
-                    'users': {},
-                    'created_at': datetime.now().isoformat(),
-                    'room_id': room_id
-                }
-                print(f'Created new room: {room_id}')
-            
-            # Add user to room
+            # Add user to room (created if it doesn't exist)
             user_data = {
                 'id': request.sid,
                 'role': user_role,
                 'name': user_name,
                 'joined_at': datetime.now().isoformat()
             }
-            
-            rooms[room_id]['users'][request.sid] = user_data
-            
-            print(f'User {user_name} ({user_role}) joined room {room_id}. Total users: {len(rooms[room_id]["users"])}')
+
+            created, users = room_store.add_user(room_id, request.sid, user_data)
+            if created:
+                print(f'Created new room: {room_id}')
+
+            print(f'User {user_name} ({user_role}) joined room {room_id}. Total users: {len(users)}')
             
             # Notify user they joined successfully
             emit('joined-room', {
                 'roomId': room_id,
                 'user': user_data,
-                'users': list(rooms[room_id]['users'].values()),
+                'users': users,
                 'timestamp': datetime.now().isoformat()
             })
             
             # Notify others in room about new user
             emit('user-joined', {
                 'user': user_data,
-                'users': list(rooms[room_id]['users'].values()),
+                'users': users,
                 'timestamp': datetime.now().isoformat()
             }, room=room_id, include_self=False)
             
         except Exception as e:
             print(f'Error in join-room: {e}')
-            emit('error', {'message': f'Failed to join room: {str(e)}'})
+            signal_error('join-room', f'Failed to join room: {str(e)}')
 
     @socketio.on('offer')
+    @signaling_metrics.instrument('offer')
     def handle_offer(data):
         try:
             room_id = data['roomId']
@@ -112,25 +244,24 @@ def init_webrtc_signaling(app):
             
             print(f'Relaying offer in room {room_id} from {request.sid}')
             
-            # Validate room exists
-            if room_id not in rooms:
-                emit('error', {'message': 'Room not found'})
-                return
-            
-            # Send offer to all other users in room
-            emit('offer', {
+            # Send offer to the addressed peer, or to all other users in room
+            error = relay('offer', room_id, {
                 'offer': offer,
                 'from': request.sid,
                 'timestamp': datetime.now().isoformat()
-            }, room=room_id, include_self=False)
+            }, data.get('to'))
+            if error:
+                signal_error('offer', error)
+                return
             
             print(f'Offer relayed successfully in room {room_id}')
             
         except Exception as e:
             print(f'Error in offer: {e}')
-            emit('error', {'message': f'Failed to send offer: {str(e)}'})
+            signal_error('offer', f'Failed to send offer: {str(e)}')
 
     @socketio.on('answer')
+    @signaling_metrics.instrument('answer')
     def handle_answer(data):
         try:
             room_id = data['roomId']
@@ -138,59 +269,55 @@ def init_webrtc_signaling(app):
             
             print(f'Relaying answer in room {room_id} from {request.sid}')
             
-            # Validate room exists
-            if room_id not in rooms:
-                emit('error', {'message': 'Room not found'})
-                return
-            
-            # Send answer to all other users in room
-            emit('answer', {
+            # Send answer to the addressed peer, or to all other users in room
+            error = relay('answer', room_id, {
                 'answer': answer,
                 'from': request.sid,
                 'timestamp': datetime.now().isoformat()
-            }, room=room_id, include_self=False)
+            }, data.get('to'))
+            if error:
+                signal_error('answer', error)
+                return
             
             print(f'Answer relayed successfully in room {room_id}')
             
         except Exception as e:
             print(f'Error in answer: {e}')
-            emit('error', {'message': f'Failed to send answer: {str(e)}'})
+            signal_error('answer', f'Failed to send answer: {str(e)}')
 
     @socketio.on('ice-candidate')
+    @signaling_metrics.instrument('ice-candidate')
     def handle_ice_candidate(data):
         try:
             room_id = data['roomId']
             candidate = data['candidate']
             
-            print(f'Relaying ICE candidate in room {room_id} from {request.sid}')
-            
-            # Validate room exists
-            if room_id not in rooms:
-                emit('error', {'message': 'Room not found'})
-                return
-            
-            # Send ICE candidate to all other users in room
-            emit('ice-candidate', {
-                'candidate': candidate,
-                'from': request.sid,
-                'timestamp': datetime.now().isoformat()
-            }, room=room_id, include_self=False)
+            if SIGNALING_ICE_BATCH_MS > 0:
+                error = batch_ice(room_id, candidate, data.get('to'))
+            else:
+                # Send ICE candidate to the addressed peer, or to all other users in room
+                error = relay('ice-candidate', room_id, {
+                    'candidate': candidate,
+                    'from': request.sid,
+                    'timestamp': datetime.now().isoformat()
+                }, data.get('to'))
+                if not error:
+                    count_ice(room_id, candidates=1, frames=1)
+            if error:
+                signal_error('ice-candidate', error)
             
         except Exception as e:
             print(f'Error in ice-candidate: {e}')
-            emit('error', {'message': f'Failed to send ICE candidate: {str(e)}'})
+            signal_error('ice-candidate', f'Failed to send ICE candidate: {str(e)}')
 
     @socketio.on('leave-room')
+    @signaling_metrics.instrument('leave-room')
     def handle_leave_room(data):
         try:
             room_id = data['roomId']
             
-            if room_id in rooms and request.sid in rooms[room_id]['users']:
-                # Get user data before removing
-                user_data = rooms[room_id]['users'][request.sid]
-                
-                # Remove user from room
-                del rooms[room_id]['users'][request.sid]
+            user_data, remaining, deleted = room_store.remove_user(room_id, request.sid)
+            if user_data is not None:
                 leave_room(room_id)
                 
                 print(f'User {user_data["name"]} left room {room_id}')
@@ -198,29 +325,31 @@ def init_webrtc_signaling(app):
                 # Notify others in room
                 emit('user-left', {
                     'user': user_data,
-                    'users': list(rooms[room_id]['users'].values()),
+                    'users': remaining,
                     'timestamp': datetime.now().isoformat()
                 }, room=room_id)
                 
-                # Clean up empty rooms
-                if len(rooms[room_id]['users']) == 0:
+                # Empty rooms are cleaned up by the store
+                if deleted:
                     print(f'Cleaning up empty room: {room_id}')
-                    del rooms[room_id]
+                    ice_stats.pop(room_id, None)
                     
         except Exception as e:
             print(f'Error in leave-room: {e}')
-            emit('error', {'message': f'Failed to leave room: {str(e)}'})
+            signal_error('leave-room', f'Failed to leave room: {str(e)}')
 
     @socketio.on('get-room-info')
+    @signaling_metrics.instrument('get-room-info')
     def handle_get_room_info(data):
         try:
             room_id = data['roomId']
             
-            if room_id in rooms:
+            room = room_store.get_room(room_id)
+            if room:
                 emit('room-info', {
                     'roomId': room_id,
-                    'users': list(rooms[room_id]['users'].values()),
-                    'created_at': rooms[room_id]['created_at'],
+                    'users': room['users'],
+                    'created_at': room['created_at'],
                     'timestamp': datetime.now().isoformat()
                 })
             else:
@@ -233,11 +362,49 @@ def init_webrtc_signaling(app):
                 
         except Exception as e:
             print(f'Error in get-room-info: {e}')
-            emit('error', {'message': f'Failed to get room info: {str(e)}'})
+            signal_error('get-room-info', f'Failed to get room info: {str(e)}')
+
+    @socketio.on('subscribe-video-session')
+    @signaling_metrics.instrument('subscribe-video-session')
+    def handle_subscribe_video_session(data):
+        """Receive 'video-session-state' whenever the session changes, instead of polling"""
+        try:
+            session_id = data['sessionId']
+            db = getattr(app, 'db', None)
+            if db is None:
+                signal_error('subscribe-video-session', 'Video sessions are not available on this server')
+                return
+
+            try:
+                claims = jwt.decode(data.get('token', ''), app.config['SECRET_KEY'], algorithms=["HS256"])
+            except jwt.InvalidTokenError:
+                signal_error('subscribe-video-session', 'Invalid token')
+                return
+
+            session = db.video_sessions.find_one({"_id": ObjectId(session_id)})
+            if not session:
+                signal_error('subscribe-video-session', 'Video session not found')
+                return
+            # Same rule as join_video_session: patients only see their own sessions
+            if claims.get('role') == 'patient' and session.get('patient_email') != claims.get('email'):
+                signal_error('subscribe-video-session', 'Access denied')
+                return
+
+            join_room(video_session_room(session_id))
+            emit('video-session-state', video_session_state(session))
+
+        except Exception as e:
+            print(f'Error in subscribe-video-session: {e}')
+            signal_error('subscribe-video-session', f'Failed to subscribe: {str(e)}')
+
+    @socketio.on('unsubscribe-video-session')
+    def handle_unsubscribe_video_session(data):
+        leave_room(video_session_room(data.get('sessionId')))
 
     # Global error handling
     @socketio.on_error_default
     def default_error_handler(e):
+        signaling_metrics.errors.inc('unhandled')
         print(f'SocketIO error: {e}')
         emit('error', {
             'message': str(e),
@@ -252,18 +419,45 @@ def init_webrtc_signaling(app):
             'client_id': request.sid
         })
 
+    def admin_authorized():
+        header = request.headers.get('Authorization', '')
+        return bool(SIGNALING_ADMIN_TOKEN) and hmac.compare_digest(header.encode(), f"Bearer {SIGNALING_ADMIN_TOKEN}".encode())
+
+    @app.route('/api/signaling/metrics', methods=['GET'])
+    def signaling_metrics_endpoint():
+        """Prometheus scrape endpoint for this process"""
+        if SIGNALING_ADMIN_TOKEN and not admin_authorized():
+            return jsonify({'message': 'Invalid admin token'}), 403
+        rooms = room_store.all_rooms()
+        users = sum(len(room['users']) for room in rooms.values())
+        return Response(signaling_metrics.render(len(rooms), users), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/api/signaling/rooms', methods=['GET'])
+    def signaling_rooms_endpoint():
+        """Admin view of active rooms and their ICE relay counters"""
+        if not admin_authorized():
+            return jsonify({'message': 'Invalid admin token'}), 403
+        return jsonify(get_active_rooms())
+
     print("WebRTC signaling server initialized successfully")
     return socketio
 
+def ice_room_stats(room_id):
+    """ICE relay counters for room_id in this process, including frames saved by batching"""
+    stats = ice_stats.get(room_id, {'candidates': 0, 'frames': 0})
+    return {**stats, 'frames_saved': stats['candidates'] - stats['frames']}
+
 def get_active_rooms():
     """Get information about active rooms"""
+    rooms = room_store.all_rooms()
     return {
         'total_rooms': len(rooms),
         'rooms': {
             room_id: {
                 'user_count': len(room_data['users']),
-                'users': [user['name'] + ' (' + user['role'] + ')' for user in room_data['users'].values()],
-                'created_at': room_data['created_at']
+                'users': [user['name'] + ' (' + user['role'] + ')' for user in room_data['users']],
+                'created_at': room_data['created_at'],
+                'ice': ice_room_stats(room_id)
             }
             for room_id, room_data in rooms.items()
         }
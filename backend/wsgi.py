@@ -0,0 +1,8 @@
+"""
+Production entry point: the REST API and the Socket.IO signaling server in one app.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app
+
+app = create_app()